@@ -16,10 +16,39 @@
 # If you have any questions regarding the software of the license, please
 # contact kreimer@fortifyiq.com
 
+import os
+
 import numpy as np
 
+# The number of set bits in every 16-bit value
+WORD_POPCOUNTS = np.array([bin(value).count('1') for value in range(1 << 16)], dtype=np.uint8)
+
+
+def popcount_native(t):
+    """Number of set bits in every element of t, in the type of t, using
+    np.bitwise_count (NumPy 2.0 or later). t is overwritten."""
+    if isinstance(t, np.ndarray):
+        return np.bitwise_count(t, out=t)
+    return type(t)(np.bitwise_count(t))
+
+
+def popcount_table(t):
+    """Number of set bits in every element of t, in the type of t, using a
+    lookup table of the 16-bit values"""
+    values = np.asarray(t)
+    words = np.ascontiguousarray(values).view(np.uint16).reshape(values.shape + (-1,))
+    counts = WORD_POPCOUNTS[words[..., 0]].astype(values.dtype)
+    for index in range(1, words.shape[-1]):
+        counts += WORD_POPCOUNTS[words[..., index]]
+    return counts if isinstance(t, np.ndarray) else type(t)(counts)
+
 
 class Sha2:
+    @classmethod
+    def hd(cls, x, y):
+        """Hamming distance between x and y, elementwise"""
+        return cls.popcount(x ^ y)
+
     def round(self, state, w, rk, return_sample):
         temp1 = self.dtype(
             state[7] +
@@ -56,27 +85,11 @@ class Sha2:
         first_block = iv is None
         if first_block:
             iv = self.iv
+        # A single block is processed as a batch of one
+        blocks = w if len(w.shape) > 1 else w[:, None]
+        state, trace = self.run_rounds(blocks, iv, len(self.round_const), trace_size)
         if len(w.shape) == 1:
-            state = iv.copy()
-        else:
-            state = np.transpose(np.broadcast_to(iv, (w.shape[1], 8)))
-        round_count = len(self.round_const)
-        trace = []
-        for i in range(round_count):
-            if i >= 16:
-                wlast = self.sigma1(w[14]) + w[9] + self.sigma0(w[1]) + w[0]
-            else:
-                wlast = w[0].copy()
-            w[:-1] = w[1:]
-            w[-1] = wlast
-            state, sample, junk, junk = self.round(
-                state,
-                wlast,
-                self.round_const[i],
-                i < trace_size
-            )
-            if i < trace_size:
-                trace.append(sample)
+            state, trace = state[:, 0], trace[:, 0]
         if first_block:
             state += iv
             junk, junk, delta_a, delta_e = self.round(
@@ -88,9 +101,77 @@ class Sha2:
             return np.append(state, [delta_a, delta_e])
         return (
             np.transpose(np.broadcast_to(iv, state.shape[::-1])) + state,
-            np.array(trace)
+            trace
         )
 
+    def run_rounds(self, blocks, iv, round_count, trace_size):
+        """The state after the first round_count rounds on the batch of blocks
+        (16 x count) from the initial state iv (8 words, or count x 8), and the
+        samples of the first trace_size of these rounds (trace_size x count).
+        The cost is linear in round_count. The blocks are overwritten by the
+        message schedule."""
+
+        count = blocks.shape[1]
+        # The registers A, B, C, D are regs[0, (k - i) % 4] for k = 0, 1, 2, 3
+        # in round i, and similarly E, F, G, H are regs[1, ...]. Every round
+        # writes the new A and E over D and H, so the registers are never moved
+        regs = np.array(
+            np.transpose(np.broadcast_to(iv, (count, 8))), dtype=self.dtype
+        ).reshape(2, 4, count)
+        temp1, temp2, temp3, temp4 = np.empty((4, count), dtype=self.dtype)
+        trace = np.empty((min(trace_size, round_count), count), dtype=np.uint16)
+        for i in range(round_count):
+            a, b, c, d = (regs[0, (k - i) % 4] for k in range(4))
+            e, f, g, h = (regs[1, (k - i) % 4] for k in range(4))
+            # The message schedule is a circular buffer of 16 words, where W_i
+            # replaces W_(i-16)
+            wi = blocks[i % 16]
+            if i >= 16:
+                self.xor_shifts(blocks[(i - 2) % 16], self.sigma1_shifts, temp1, temp2)
+                wi += temp1
+                wi += blocks[(i - 7) % 16]
+                self.xor_shifts(blocks[(i - 15) % 16], self.sigma0_shifts, temp1, temp2)
+                wi += temp1
+            if i < trace_size:
+                trace[i] = (
+                    self.hd(a, b) + self.hd(b, c) + self.hd(c, d)
+                    + self.hd(e, f) + self.hd(f, g) + self.hd(g, h)
+                )
+            # temp1 = H + S1(E) + Ch(E, F, G) + K_i + W_i
+            self.xor_shifts(e, self.s1_shifts, temp1, temp2)
+            temp1 += h
+            np.bitwise_xor(f, g, out=temp2)
+            temp2 &= e
+            temp2 ^= g
+            temp1 += temp2
+            temp1 += self.round_const[i]
+            temp1 += wi
+            # temp3 = S0(A) + Maj(A, B, C)
+            self.xor_shifts(a, self.s0_shifts, temp3, temp2)
+            np.bitwise_or(b, c, out=temp2)
+            temp2 &= a
+            np.bitwise_and(b, c, out=temp4)
+            temp2 |= temp4
+            temp3 += temp2
+            np.add(d, temp1, out=h)
+            np.add(temp1, temp3, out=d)
+            if i < trace_size:
+                trace[i] += self.hd(d, a) + self.hd(h, e)
+        return regs[:, (np.arange(4) - round_count) % 4].reshape(8, count), trace
+
+    @classmethod
+    def xor_shifts(cls, x, shifts, out, scratch):
+        """XOR of x shifted by every one of shifts (to the right if positive,
+        to the left if negative) into out, without allocating"""
+        for index, shift in enumerate(shifts):
+            target = scratch if index else out
+            if shift > 0:
+                np.right_shift(x, cls.dtype(shift), out=target)
+            else:
+                np.left_shift(x, cls.dtype(-shift), out=target)
+            if index:
+                out ^= scratch
+
     @staticmethod
     def show(data, size, total_nibble_count):
         if size == -1:
@@ -130,21 +211,27 @@ class Sha256(Sha2):
         0x510e527f, 0x9b05688c, 0x1f83d9ab, 0x5be0cd19
     ], dtype=np.uint32)
     nibbles_in_block = 128
+    # The shifts of s0, s1, sigma0, sigma1 (see Sha2.xor_shifts)
+    s0_shifts = (2, -30, 13, -19, 22, -10)
+    s1_shifts = (6, -26, 11, -21, 25, -7)
+    sigma0_shifts = (7, -25, 18, -14, 3)
+    sigma1_shifts = (17, -15, 19, -13, 10)
     ipad = np.uint32(0x36363636)
     opad = np.uint32(0x5c5c5c5c)
-    isize = [2, 0x40]
+    # The length field (the last two words) of the second block of the inner
+    # hash of HMAC on a two-word message, i.e., 72 bytes
+    isize = [0, 0x240]
 
     @staticmethod
     def show(data, size):
         return Sha2.show(data, size, Sha256.nibble_count)
 
     @staticmethod
-    def hd(x, y):
+    def popcount_swar(t):
         m1 = 0x55555555
         m2 = 0x33333333
         m4 = 0x0f0f0f0f
         h01 = 0x01010101
-        t = x ^ y
         t -= (t >> 1) & m1
         t = (t & m2) + ((t >> 2) & m2)
         t = (t + (t >> 4)) & m4
@@ -234,8 +321,15 @@ class Sha512(Sha2):
         0x510e527fade682d1, 0x9b05688c2b3e6c1f, 0x1f83d9abfb41bd6b, 0x5be0cd19137e2179,
     ], dtype=np.uint64)
     nibbles_in_block = 256
+    # The shifts of s0, s1, sigma0, sigma1 (see Sha2.xor_shifts)
+    s0_shifts = (28, -36, 34, -30, 39, -25)
+    s1_shifts = (14, -50, 18, -46, 41, -23)
+    sigma0_shifts = (1, -63, 8, -56, 7)
+    sigma1_shifts = (19, -45, 61, -3, 6)
     ipad = np.uint64(0x3636363636363636)
     opad = np.uint64(0x5c5c5c5c5c5c5c5c)
+    # The length field of the second block of the inner hash of HMAC on a
+    # two-word message, i.e., 144 bytes (see Sha256)
     isize = [0, 0x480]
 
     @staticmethod
@@ -243,12 +337,11 @@ class Sha512(Sha2):
         return Sha2.show(data, size, Sha512.nibble_count)
 
     @staticmethod
-    def hd(x, y):
+    def popcount_swar(t):
         m1 = np.uint64(0x5555555555555555)
         m2 = np.uint64(0x3333333333333333)
         m4 = np.uint64(0x0f0f0f0f0f0f0f0f)
         h01 = np.uint64(0x0101010101010101)
-        t = x ^ y
         t -= (t >> np.uint64(1)) & m1
         t = (t & m2) + ((t >> np.uint64(2)) & m2)
         t = (t + (t >> np.uint64(4))) & m4
@@ -287,6 +380,16 @@ class Sha512(Sha2):
 
     @staticmethod
     def sigma0(w):
+        return np.uint64(
+            (w >> np.uint64(1))
+            ^ (w << np.uint64(63))
+            ^ (w >> np.uint64(8))
+            ^ (w << np.uint64(56))
+            ^ (w >> np.uint64(7))
+        )
+
+    @staticmethod
+    def sigma1(w):
         return np.uint64(
             (w >> np.uint64(19))
             ^ (w << np.uint64(45))
@@ -295,12 +398,25 @@ class Sha512(Sha2):
             ^ (w >> np.uint64(6))
         )
 
-    @staticmethod
-    def sigma1(w):
-        return np.uint64(
-            (w >> np.uint64(1))
-            ^ (w << np.uint64(63))
-            ^ (w >> np.uint64(8))
-            ^ (w << np.uint64(56))
-            ^ (w >> np.uint64(7))
+
+def set_popcount(backend):
+    """Select the implementation of the popcount used by Sha256.hd and
+    Sha512.hd. All of them give identical results.
+
+    'native' - np.bitwise_count (NumPy 2.0 or later);
+    'table' - a lookup table of the 16-bit values;
+    'swar' - bitwise arithmetic ("SIMD within a register").
+    """
+    for sha in Sha256, Sha512:
+        sha.popcount = staticmethod(
+            {'native': popcount_native, 'table': popcount_table, 'swar': sha.popcount_swar}[backend]
         )
+
+
+# The available popcount backends, the fastest first. The environment variable
+# SHA2_POPCOUNT overrides the default backend
+POPCOUNT_BACKENDS = ('swar', 'table')
+if hasattr(np, 'bitwise_count'):
+    POPCOUNT_BACKENDS = ('native',) + POPCOUNT_BACKENDS
+DEFAULT_POPCOUNT = os.environ.get('SHA2_POPCOUNT', POPCOUNT_BACKENDS[0])
+set_popcount(DEFAULT_POPCOUNT)
@@ -16,13 +16,54 @@
 # If you have any questions regarding the software of the license, please
 # contact kreimer@fortifyiq.com
 
+import itertools
+import warnings
 from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
 
 import numpy as np
 
+from sha2_profile import NO_PROFILER
+from sha2_trace_set import as_trace_set
+
 
 Stage1hypo = namedtuple('Stage1hypo', ['nextA', 'prevA', 'nextE', 'prevE'])
 
+# A partition of the traces whose average traces a decision needs (see
+# TraceSet.partition_averages). fields and classes, if set, describe the same
+# partition for the bit-plane index (see BitPlaneIndex.partition_sums)
+Partition = namedtuple(
+    'Partition',
+    ['classify', 'class_count', 'column', 'key', 'fields', 'classes'],
+    defaults=(None, None),
+)
+
+
+def run_steps(steps, averages):
+    """Perform a decision given as a generator that yields the partitions it
+    needs and receives their averages, computed by averages(partition)"""
+
+    try:
+        partition = next(steps)
+        while True:
+            partition = steps.send(averages(partition))
+    except StopIteration:
+        pass
+
+
+def partition_averages(trace_set, index, partition):
+    """Average trace in every class of partition, using the bit-plane index
+    if it is set and the partition is described for it"""
+
+    if index is not None and partition.fields is not None:
+        sums, counts = index.partition_sums(
+            partition.fields, partition.classes, partition.class_count
+        )
+        return sums / counts
+    return trace_set.partition_averages(
+        partition.classify, partition.class_count, partition.column, partition.key
+    )
+
 
 def fit(pair, pattern, bit_size):
     return np.all((pair >> bit_size ^ pattern) & 1 == 0) if bit_size > 0 else True
@@ -60,7 +101,16 @@ class Stage1state:
         (3, -1, 1): ((0, 1),),
     }
 
-    def __init__(self, sha2, data, traces, verbose):
+    # Pairs of two bits of DeltaA_0 + W_0 and DeltaE_0 + W_0 distinguished
+    # after the first mismatch, in the order of the corresponding classes
+    mismatch_pairs = ((0, 0), (1, 0), (1, 1), (2, 1), (2, 2), (3, 2), (3, 3), (0, 3))
+    mismatch_classes = np.full(16, len(mismatch_pairs), dtype=np.intp)
+    mismatch_classes[[x + 4 * y for (x, y) in mismatch_pairs]] = np.arange(len(mismatch_pairs))
+
+    def __init__(self, sha2, data, traces, verbose, profiler=NO_PROFILER, index=None):
+        """index is the bit-plane index of the traces (see TraceSet.bit_planes),
+        which is built if not set"""
+
         self.sha2 = sha2
         self.known_bits = 0
 
@@ -71,23 +121,37 @@ class Stage1state:
         # consistent with the order of self.nexts)
         self.prevs = np.zeros((1, 2), dtype=sha2.dtype)
 
-        # For every step, call self.find_bit_before_mismatch
+        # For every step, perform self.find_bit_before_mismatch
         # until the first mismatch between DeltaA_0 and DeltaE_0
-        self.find_bit = self.find_bit_before_mismatch
-        self.data = data
-        self.traces = traces
+        self.bit_steps = self.find_bit_before_mismatch
+        self.trace_set = as_trace_set(data, traces)
+        self.index = index or self.trace_set.bit_planes(sha2)
         self.verbose = verbose
+        self.profiler = profiler
+
+    def find_bit(self, bit_index):
+        run_steps(
+            self.bit_steps(bit_index),
+            lambda partition: partition_averages(self.trace_set, self.index, partition),
+        )
+
+    def partition(self, classify, class_count, key, fields, classes=None):
+        """Partition by the first trace. fields and classes describe the same
+        partition as classify in terms of the bits of W_0 + x."""
+        self.profiler.count_classes(class_count)
+        return Partition(classify, class_count, 0, key, fields, classes)
 
     def update_prevs(self, current_index, hd):
         """Substage 1b (section 3.4.2) up to the least significant mismatching
         bit between DeltaA_0 and DeltaE_0 (case 1 in section 3.4.1)"""
 
         mask = self.sha2.dtype((1 << (current_index + 2)) - 1)
-        subsets = [
-            (((self.data[:, 0] + (self.nexts[0] & mask)) >> current_index) & 3) == x
-            for x in range(4)
-        ]
-        averages = np.array([np.average(self.traces[x, 0]) for x in subsets])
+        averages = yield self.partition(
+            lambda data: ((data[:, 0] + (self.nexts[0] & mask)) >> current_index) & 3,
+            4,
+            ('1b', current_index, int(self.nexts[0] & mask)),
+            [(self.nexts[0] & mask, current_index, 2)],
+        )
         difs = tuple(np.around(averages[1:] - averages[:-1]).astype(int))
         if difs not in hd:
             raise ValueError('{}'.format(current_index))
@@ -123,11 +187,12 @@ class Stage1state:
         assert bit_index >= self.known_bits
         unknown_bits = bit_index + 1 - self.known_bits
         mask = (1 << (unknown_bits + 1)) - 1
-        subsets = [
-            (((self.data[:, 0] + self.nexts[0]) >> self.known_bits) & mask) == x
-            for x in range(1 << (unknown_bits + 1))
-        ]
-        averages = np.array([np.average(self.traces[x, 0]) for x in subsets])
+        averages = yield self.partition(
+            lambda data: ((data[:, 0] + self.nexts[0]) >> self.known_bits) & mask,
+            mask + 1,
+            ('1a', self.known_bits, mask, int(self.nexts[0])),
+            [(self.nexts[0], self.known_bits, unknown_bits + 1)],
+        )
         rotated = [
             np.concatenate((averages[i:], averages[:i]))[: 1 << unknown_bits]
             for i in (1, 1 << unknown_bits, 1 + (1 << unknown_bits))
@@ -179,8 +244,8 @@ class Stage1state:
 
         # Subcase 1.3 - the first mismatch between DeltaA_0 and DeltaE0
         if len(indices) == 2:
-            # From now on, call self.find_bit for every step
-            self.find_bit = self.find_bit_after_mismatch
+            # From now on, perform self.find_bit_after_mismatch for every step
+            self.bit_steps = self.find_bit_after_mismatch
             self.nexts += (((1 << unknown_bits) - 1 - indices) << self.known_bits).astype(
                 self.sha2.dtype
             )
@@ -201,10 +266,11 @@ class Stage1state:
                     )
                 )
                 print('\nStage 1b - finding A, E until the first mismatch')
+            self.profiler.switch('1b', options=len(self.prevs))
             for current_index in range(bit_index):
-                self.update_prevs(current_index, self.hd_eq)
+                yield from self.update_prevs(current_index, self.hd_eq)
             self.prevs[:, 1] ^= 1 << bit_index
-            self.update_prevs(bit_index, self.hd_ne)
+            yield from self.update_prevs(bit_index, self.hd_ne)
             if self.verbose:
                 print('\nStage 1c - finding A, E, deltaA, deltaE after the first mismatch')
             self.prevs[:, 1] ^= 2 << bit_index
@@ -220,12 +286,20 @@ class Stage1state:
         assert bit_index == self.known_bits
 
         nexts = [self.nexts[i] for i in (0, 1)]
-        subsets = [
-            ((((self.data[:, 0] + nexts[0]) >> self.known_bits) & 3) == x)
-            * ((((self.data[:, 0] + nexts[1]) >> self.known_bits) & 3) == y)
-            for (x, y) in ((0, 0), (1, 0), (1, 1), (2, 1), (2, 2), (3, 2), (3, 3), (0, 3))
-        ]
-        averages = np.array([np.average(self.traces[x, 0]) for x in subsets])
+
+        def classify(data):
+            pairs = (((data[:, 0] + nexts[0]) >> self.known_bits) & 3) + 4 * (
+                ((data[:, 0] + nexts[1]) >> self.known_bits) & 3
+            )
+            return self.mismatch_classes[pairs.astype(np.intp)]
+
+        averages = yield self.partition(
+            classify,
+            len(self.mismatch_pairs),
+            ('1c', self.known_bits, int(nexts[0]), int(nexts[1])),
+            [(nexts[0], self.known_bits, 2), (nexts[1], self.known_bits, 2)],
+            self.mismatch_classes,
+        )
         rotated = [np.concatenate((averages[i:], averages[:i]))[:4] for i in (1, 4, 5)]
         leaps = np.around(averages[:4] - rotated[0] - rotated[1] + rotated[2]).astype(int)
         indices = [i for i in range(leaps.shape[0]) if leaps[i] != 0]
@@ -289,35 +363,53 @@ class Stage1state:
 
 
 class Stage2state:
-    def __init__(self, sha2, ae_hypo, data, traces, verbose):
+    def __init__(self, sha2, ae_hypo, data, traces, verbose, profiler=NO_PROFILER):
         self.sha2 = sha2
-        self.a = [sha2.dtype(0)] * 3 + [sha2.dtype(ae_hypo.prevA), ae_hypo.nextA + data[:, 0]]
-        self.e = [sha2.dtype(0)] * 3 + [sha2.dtype(ae_hypo.prevE), ae_hypo.nextE + data[:, 0]]
-        self.data = data
-        self.traces = traces
-        self.sigma1 = sha2.s1(self.e[4])
-        self.sigma0 = sha2.s0(self.a[4])
+        self.a = [sha2.dtype(0)] * 3 + [sha2.dtype(ae_hypo.prevA)]
+        self.e = [sha2.dtype(0)] * 3 + [sha2.dtype(ae_hypo.prevE)]
+        self.trace_set = as_trace_set(data, traces)
         self.nextA = sha2.dtype(ae_hypo.nextA)
         self.nextE = sha2.dtype(ae_hypo.nextE)
         self.verbose = verbose
+        # The terms of a trace set of a single chunk are computed only once
+        # and shared by both partitions of every bit
+        self.cached_terms = None
+        self.profiler = profiler
+
+    def partition_averages(self, classify):
+        """Average second trace in the four classes (see
+        TraceSet.partition_averages)"""
+        self.profiler.count_classes(4)
+        return self.trace_set.partition_averages(classify, 4, 1)
+
+    def terms(self, data):
+        """A_1, E_1, Sigma0(A_1) and Sigma1(E_1) + W_1 + K_1 for a chunk of
+        inputs"""
+
+        # As in Stage2batch.terms, only the chunk of the whole trace set is cached
+        if len(data) == len(self.trace_set):
+            if self.cached_terms is None:
+                self.cached_terms = self.compute_terms(data)
+            return self.cached_terms
+        return self.compute_terms(data)
+
+    def compute_terms(self, data):
+        a = self.nextA + data[:, 0]
+        e = self.nextE + data[:, 0]
+        return a, e, self.sha2.s0(a), self.sha2.s1(e) + data[:, 1] + self.sha2.round_const[1]
 
     def find_bit(self, bit_index):
         mask = self.sha2.dtype((1 << bit_index) - 1)
         point_mask = self.sha2.dtype(1 << bit_index)
-        sum_en = self.sigma1 + self.data[:, 1] + self.sha2.round_const[1]
-        sum_e = self.e[4] ^ (
-            sum_en + (self.sha2.ch(self.e[4], self.e[3], self.e[2]) & mask) + (self.a[1] & mask)
-        )
-        subsets_e = [
-            [
-                (((sum_e >> bit_index) & 1) == i) * (((self.e[4] >> bit_index) & 1) == j)
-                for j in (0, 1)
-            ]
-            for i in (0, 1)
-        ]
-        averages_e = [
-            [np.average(self.traces[subsets_e[i][j], 1]) for j in (0, 1)] for i in (0, 1)
-        ]
+
+        def classify_e(data):
+            a, e, sigma0, sum_en = self.terms(data)
+            sum_e = e ^ (
+                sum_en + (self.sha2.ch(e, self.e[3], self.e[2]) & mask) + (self.a[1] & mask)
+            )
+            return ((sum_e >> bit_index) & 1) * 2 + ((e >> bit_index) & 1)
+
+        averages_e = self.partition_averages(classify_e).reshape(2, 2)
         diff_cg = np.around(averages_e[1][1] - averages_e[0][1]).astype(int)
         if abs(diff_cg) != 1:
             raise ValueError('CG error')
@@ -332,24 +424,19 @@ class Stage2state:
         ) ^ (self.e[3] & point_mask)
 
         big_mask = (1 << (bit_index + 1)) - 1
-        sum_an = sum_en + self.sigma0 + (self.sha2.maj(self.a[4], self.a[3], self.a[2]) & mask)
-        sum_an2 = (
-            sum_an
-            + (self.e[1] & mask)
-            + (self.sha2.ch(self.e[4], self.e[3], self.e[2]) & big_mask)
-        )
-        sum_a = self.a[4] ^ sum_an2
-        subsets_a = [
-            [
-                (((sum_a >> bit_index) & 1) == i)
-                * ((((self.a[4] ^ self.a[3]) >> bit_index) & 1) == j)
-                for j in (0, 1)
-            ]
-            for i in (0, 1)
-        ]
-        averages_a = [
-            [np.average(self.traces[subsets_a[i][j], 1]) for j in (0, 1)] for i in (0, 1)
-        ]
+
+        def classify_a(data):
+            a, e, sigma0, sum_en = self.terms(data)
+            sum_an = sum_en + sigma0 + (self.sha2.maj(a, self.a[3], self.a[2]) & mask)
+            sum_an2 = (
+                sum_an
+                + (self.e[1] & mask)
+                + (self.sha2.ch(e, self.e[3], self.e[2]) & big_mask)
+            )
+            sum_a = a ^ sum_an2
+            return ((sum_a >> bit_index) & 1) * 2 + (((a ^ self.a[3]) >> bit_index) & 1)
+
+        averages_a = self.partition_averages(classify_a).reshape(2, 2)
         diff_g = np.around(averages_a[1][0] - averages_a[0][0]).astype(int)
         if abs(diff_g) != 1:
             raise ValueError('G error')
@@ -418,67 +505,523 @@ class Stage2state:
                 )
             )
 
-        return self.a[:-1][::-1] + self.e[:-1][::-1]
+        return self.a[::-1] + self.e[::-1]
+
+
+class Stage2batch:
+    """Stage 2 for a batch of hypotheses at once.
+
+    The words found at stage 2 are arrays with one entry per hypothesis, and
+    the values that depend on the inputs are (hypotheses x traces) arrays.
+    Every bit is decided for all the surviving hypotheses in one vectorized
+    step, and the hypotheses rejected at a bit are dropped immediately.
+
+    The hypotheses form a tree by their low bits: the hypotheses of stage 1
+    that differ only in the MSBs of A_0, E_0 (section 3.4.3) or in the high
+    bits of A_{-1}, E_{-1} have the same classes at the lower bits. At every
+    bit, the classes and averages are computed once per distinct node of the
+    tree and shared by all the hypotheses in it (see shared_rows).
+    """
+
+    # Estimated number of bytes per hypothesis and trace in a chunk
+    bytes_per_cell = 96
+    # Default limit on the memory used by one batch
+    memory_limit = 1 << 28
+
+    def __init__(self, sha2, stage1_hypos, data, traces, screening=False, profiler=NO_PROFILER):
+        """If screening, no hypothesis is rejected. Instead, the bits are
+        decided by the signs of the differences of the averages, and
+        self.deviations keeps the greatest mean squared deviation of their
+        absolute values from 1 at a bit."""
+
+        self.sha2 = sha2
+        self.indices = np.arange(len(stage1_hypos))
+        self.nextA = np.array([hypo.nextA for hypo in stage1_hypos], dtype=sha2.dtype)
+        self.nextE = np.array([hypo.nextE for hypo in stage1_hypos], dtype=sha2.dtype)
+        self.a = [np.zeros(len(stage1_hypos), dtype=sha2.dtype) for i in range(3)] + [
+            np.array([hypo.prevA for hypo in stage1_hypos], dtype=sha2.dtype)
+        ]
+        self.e = [np.zeros(len(stage1_hypos), dtype=sha2.dtype) for i in range(3)] + [
+            np.array([hypo.prevE for hypo in stage1_hypos], dtype=sha2.dtype)
+        ]
+        self.trace_set = as_trace_set(data, traces)
+        self.deviations = np.zeros(len(stage1_hypos)) if screening else None
+        # The terms of a trace set of a single chunk are computed only once
+        self.cached_terms = None
+        self.profiler = profiler
+        # The bits of Sigma0(A_1), Sigma1(E_1) up to bit i depend on the bits
+        # of A_1, E_1 up to bit i + the greatest right rotation
+        self.reach_a = max(sha2.s0_shifts)
+        self.reach_e = max(sha2.s1_shifts)
+
+    def terms(self, data, rows=slice(None)):
+        """A_1, E_1, Sigma0(A_1) and Sigma1(E_1) + W_1 + K_1 for a chunk of
+        inputs, as (hypotheses x traces) arrays for the hypotheses in rows"""
+
+        # Only the chunk of the whole trace set is cached, not a part of it
+        # (e.g., the traces by which a PrefixTraceSet extends its statistics)
+        if len(data) == len(self.trace_set):
+            if self.cached_terms is None:
+                self.cached_terms = self.compute_terms(data, slice(None))
+            return tuple(x[rows] for x in self.cached_terms)
+        return self.compute_terms(data, rows)
+
+    def compute_terms(self, data, rows):
+        a = self.nextA[rows, None] + data[:, 0]
+        e = self.nextE[rows, None] + data[:, 0]
+        return a, e, self.sha2.s0(a), self.sha2.s1(e) + data[:, 1] + self.sha2.round_const[1]
+
+    def shared_rows(self, bit_index):
+        """The nodes of the tree of hypotheses at bit bit_index: the indices of
+        one hypothesis per node, and the node of every hypothesis (or two
+        full slices if every node has one hypothesis).
+
+        The hypotheses of a node agree on all the bits that the classes at
+        bit bit_index depend on, so they have the same averages.
+        """
+
+        def low(bit_count):
+            return self.sha2.dtype((1 << min(bit_count, self.sha2.bit_count)) - 1)
+
+        mask = low(bit_index + 1)
+        state = np.array(
+            [
+                self.nextA & low(bit_index + 1 + self.reach_a),
+                self.nextE & low(bit_index + 1 + self.reach_e),
+            ]
+            + [x & mask for x in self.a[1:] + self.e[1:]]
+        )
+        _, rows, nodes = np.unique(state.T, axis=0, return_index=True, return_inverse=True)
+        if len(rows) == len(self.indices):
+            return slice(None), slice(None)
+        return rows, nodes.ravel()
+
+    def settle(self, *diffs):
+        """Whether every difference of the averages in diffs stands for -1,
+        and which hypotheses survive (those with all the differences +-1)"""
+
+        if self.deviations is not None:
+            self.bit_deviations += sum((np.abs(diff) - 1) ** 2 for diff in diffs) / 4
+            return [diff < 0 for diff in diffs], np.ones(len(self.indices), dtype=bool)
+        diffs = [np.around(diff) for diff in diffs]
+        return [diff == -1 for diff in diffs], np.all([np.abs(diff) == 1 for diff in diffs], 0)
+
+    def keep(self, alive):
+        """Drop the rejected hypotheses"""
+
+        self.indices = self.indices[alive]
+        if self.deviations is not None:
+            self.deviations = self.deviations[alive]
+        self.nextA = self.nextA[alive]
+        self.nextE = self.nextE[alive]
+        self.a = [x[alive] for x in self.a]
+        self.e = [x[alive] for x in self.e]
+        if self.cached_terms is not None:
+            self.cached_terms = tuple(x[alive] for x in self.cached_terms)
+
+    def partition(self, classify, key, rows):
+        """Partition by the second trace into the four classes of every
+        hypothesis in rows (see shared_rows). classify maps a chunk of data to
+        a (rows x traces) array of class indices. key identifies the
+        partition together with the state of the hypotheses (see
+        TraceSet.partition_averages)."""
+
+        row_count = len(self.indices[rows])
+        class_count = 4 * row_count
+        self.profiler.count_classes(class_count)
+        offsets = 4 * np.arange(row_count)[:, None]
+        state = np.array([self.nextA, self.nextE] + self.a[1:] + self.e[1:])[:, rows]
+        return Partition(
+            lambda data: classify(data) + offsets, class_count, 1, key + (state.tobytes(),)
+        )
+
+    def find_bit(self, bit_index):
+        run_steps(
+            self.bit_steps(bit_index),
+            lambda partition: partition_averages(self.trace_set, None, partition),
+        )
+
+    def bit_steps(self, bit_index):
+        """Decide bit bit_index for all the hypotheses. The averages of every
+        partition are received as a (rows x 4 classes) array."""
+
+        mask = self.sha2.dtype((1 << bit_index) - 1)
+        point_mask = self.sha2.dtype(1 << bit_index)
+
+        def classify_e(data):
+            a, e, sigma0, sum_en = self.terms(data, rows)
+            sum_e = e ^ (
+                sum_en
+                + (self.sha2.ch(e, self.e[3][rows, None], self.e[2][rows, None]) & mask)
+                + (self.a[1][rows] & mask)[:, None]
+            )
+            return ((sum_e >> bit_index) & 1) * 2 + ((e >> bit_index) & 1)
+
+        shift = self.sha2.dtype(bit_index)
+        if self.deviations is not None:
+            self.bit_deviations = np.zeros(len(self.indices))
+        rows, nodes = self.shared_rows(bit_index)
+        averages_e = yield self.partition(classify_e, ('2e', bit_index), rows)
+        averages_e = averages_e.reshape(-1, 4)[nodes]
+        (cg, f), alive = self.settle(
+            averages_e[:, 3] - averages_e[:, 1], averages_e[:, 2] - averages_e[:, 0]
+        )
+        self.a[1] ^= (cg.astype(self.sha2.dtype) << shift) ^ (self.e[3] & point_mask)
+        self.e[2] ^= ((f ^ cg).astype(self.sha2.dtype) << shift) ^ (self.e[3] & point_mask)
+        self.keep(alive)
+
+        big_mask = (1 << (bit_index + 1)) - 1
+
+        def classify_a(data):
+            a, e, sigma0, sum_en = self.terms(data, rows)
+            a3 = self.a[3][rows, None]
+            sum_an = sum_en + sigma0 + (self.sha2.maj(a, a3, self.a[2][rows, None]) & mask)
+            sum_an2 = (
+                sum_an
+                + (self.e[1][rows] & mask)[:, None]
+                + (self.sha2.ch(e, self.e[3][rows, None], self.e[2][rows, None]) & big_mask)
+            )
+            sum_a = a ^ sum_an2
+            return ((sum_a >> bit_index) & 1) * 2 + (((a ^ a3) >> bit_index) & 1)
+
+        rows, nodes = self.shared_rows(bit_index)
+        averages_a = yield self.partition(classify_a, ('2a', bit_index), rows)
+        averages_a = averages_a.reshape(-1, 4)[nodes]
+        (g, b), alive = self.settle(
+            averages_a[:, 2] - averages_a[:, 0], averages_a[:, 3] - averages_a[:, 1]
+        )
+        self.e[1] ^= (g.astype(self.sha2.dtype) << shift) ^ (self.a[3] & point_mask)
+        self.a[2] ^= (b.astype(self.sha2.dtype) << shift) ^ (self.e[1] & point_mask)
+        self.keep(alive)
+        if self.deviations is not None:
+            self.deviations = np.fmax(self.deviations, self.bit_deviations)
+
+    def finalize(self):
+        """Find the rest of the initial stage for every surviving hypothesis
+        (Section 3.5.1). Returns the indices of the surviving hypotheses and
+        their candidates."""
+
+        self.a[1] -= self.e[1]
+        self.e[0] = (
+            self.nextA
+            - self.sha2.s0(self.a[3])
+            - self.sha2.maj(self.a[3], self.a[2], self.a[1])
+            - self.sha2.s1(self.e[3])
+            - self.sha2.ch(self.e[3], self.e[2], self.e[1])
+            - self.sha2.round_const[0]
+        )
+        self.a[0] = (
+            self.nextE
+            - self.sha2.s1(self.e[3])
+            - self.sha2.ch(self.e[3], self.e[2], self.e[1])
+            - self.e[0]
+            - self.sha2.round_const[0]
+        )
+
+        return self.indices, [
+            list(candidate) for candidate in np.transpose(self.a[::-1] + self.e[::-1])
+        ]
 
 
-def stage1(sha2, data, traces, verbose):
+def stage1(sha2, data, traces, verbose, profiler=NO_PROFILER):
     """Stage 1 (section 3.4)"""
 
-    state = Stage1state(sha2, data, traces, verbose)
+    state = Stage1state(sha2, data, traces, verbose, profiler)
     if verbose:
         print('\nStage 1a - finding deltaA, deltaE until the first mismatch\n')
+    stage = '1a'
     for bit_index in range(sha2.bit_count - 1):
-        state.find_bit(bit_index)
+        with profiler.step(stage, bit_index, options=len(state.prevs)):
+            state.find_bit(bit_index)
+            # Substage 1b is performed at the bit of the first mismatch, in a
+            # step of its own (see find_bit_before_mismatch)
+            if stage == '1a' and state.bit_steps == state.find_bit_after_mismatch:
+                stage = '1c'
 
     return state.finalize()
 
 
-def stage2(sha2, data, traces, stage1_hypos, verbose):
-    """Stage 2 (section 3.5)"""
+def stage2_batch_size(data, traces, memory_limit=None):
+    """The number of hypotheses in a batch of stage 2 that takes up to about
+    memory_limit bytes (Stage2batch.memory_limit by default)"""
+
+    trace_set = as_trace_set(data, traces)
+    chunk_size = min(trace_set.chunk_size, len(trace_set))
+    memory_limit = memory_limit or Stage2batch.memory_limit
+    return max(1, memory_limit // (Stage2batch.bytes_per_cell * max(chunk_size, 1)))
+
+
+def stage2_batches(
+    sha2,
+    data,
+    traces,
+    stage1_hypos,
+    bit_count,
+    memory_limit=None,
+    screening=False,
+    profiler=NO_PROFILER,
+):
+    """Find the bit_count least significant bits at stage 2 for every
+    hypothesis in stage1_hypos, in batches that take up to about memory_limit
+    bytes (Stage2batch.memory_limit by default). Yields the index of the first
+    hypothesis of every batch and its Stage2batch."""
+
+    trace_set = as_trace_set(data, traces)
+    batch_size = stage2_batch_size(trace_set, None, memory_limit)
+    for start in range(0, len(stage1_hypos), batch_size):
+        stage2batch = Stage2batch(
+            sha2, stage1_hypos[start:start + batch_size], trace_set, None, screening, profiler
+        )
+        for bit_index in range(bit_count):
+            if len(stage2batch.indices) == 0:
+                break
+            with profiler.step(
+                '2-screen' if screening else '2',
+                bit_index,
+                hypotheses=len(stage2batch.indices),
+            ):
+                stage2batch.find_bit(bit_index)
+        yield start, stage2batch
+
+
+def screen_depth(sha2):
+    """The number of bits of stage 2 on which the hypotheses are pre-screened
+    by default (11 for SHA256, 26 for SHA512).
+
+    The hypotheses of stage 1 that differ only in the MSBs of A_0, E_0 have
+    the same classes at stage 2 until the MSBs of A_1, E_1 reach the bit
+    through Sigma0 and Sigma1. A shallower pre-screening cannot prune them.
+    """
+
+    return sha2.bit_count + 1 - min(max(sha2.s0_shifts), max(sha2.s1_shifts))
+
+
+def prescreen(
+    sha2,
+    data,
+    traces,
+    stage1_hypos,
+    bit_count,
+    trace_count,
+    memory_limit=None,
+    tolerance=8,
+    profiler=NO_PROFILER,
+):
+    """Rank the hypotheses on the first bit_count bits of stage 2 using the
+    first trace_count traces, and return those that are not clearly wrong.
+
+    The rank of a hypothesis is the greatest mean squared deviation of the
+    four absolute differences of the averages at a bit from 1. For the
+    correct hypothesis, it is about the variance of such a difference, which
+    is estimated from the traces. The hypotheses ranked worse than tolerance
+    times the estimated variance are pruned. Most of the wrong hypotheses are
+    pruned on a small number of traces, so that the full stage 2 runs on the
+    survivors only.
+    """
+
+    trace_set = as_trace_set(data, traces).head(trace_count)
+    moments = np.zeros(3)
+    for data, traces in trace_set.chunks():
+        column = traces[:, 1]
+        moments += [
+            len(column), np.sum(column, dtype=float), np.sum(np.square(column, dtype=float))
+        ]
+    # Each of the two averages in a difference is taken over about a quarter
+    # of the traces
+    variance = 8 * (moments[2] / moments[0] - (moments[1] / moments[0]) ** 2) / moments[0]
+    survivors = []
+    for start, stage2batch in stage2_batches(
+        sha2, trace_set, None, stage1_hypos, bit_count, memory_limit, True, profiler
+    ):
+        survivors += [
+            stage1_hypos[start + index]
+            for index, rank in zip(stage2batch.indices, stage2batch.deviations)
+            if rank <= tolerance * variance
+        ]
+    return survivors
+
+
+def stage2_candidates(
+    sha2, data, traces, stage1_hypos, verbose, memory_limit=None, profiler=NO_PROFILER
+):
+    """Stage 2 for every hypothesis in stage1_hypos. Returns the list of the
+    candidates, with None for every rejected hypothesis.
+
+    Unless verbose, the hypotheses are processed by Stage2batch, in batches
+    that take up to about memory_limit bytes (Stage2batch.memory_limit by
+    default).
+    """
+
+    candidates = []
+    if not verbose:
+        candidates = [None] * len(stage1_hypos)
+        for start, stage2batch in stage2_batches(
+            sha2, data, traces, stage1_hypos, sha2.bit_count, memory_limit, profiler=profiler
+        ):
+            for index, candidate in zip(*stage2batch.finalize()):
+                candidates[start + index] = candidate
+        return candidates
+
+    for stage1_hypo in stage1_hypos:
+        stage2state = Stage2state(sha2, stage1_hypo, data, traces, verbose, profiler)
+        print(
+            (
+                'Stage 1 hypothesis: '
+                + sha2.formatter
+                + ' ' * (sha2.nibble_count * 3 + 3)
+                + sha2.formatter
+                + '\n'
+            ).format(
+                stage1_hypo.prevA,
+                stage1_hypo.prevE,
+                stage1_hypo.nextA,
+                stage1_hypo.nextE,
+            )
+        )
+        try:
+            for bit_index in range(sha2.bit_count):
+                with profiler.step('2', bit_index, hypotheses=1):
+                    stage2state.find_bit(bit_index)
+            candidates.append(stage2state.finalize())
+        except ValueError:
+            candidates.append(None)
+            print('The hypothesis is rejected\n')
+
+    return candidates
+
+
+def init_worker(filters):
+    # Apply the warning filters of the parent process (e.g., suppressed
+    # overflows) in a worker process
+    warnings.filters[:] = filters
+
+
+def stage2(
+    sha2,
+    data,
+    traces,
+    stage1_hypos,
+    verbose,
+    jobs=1,
+    memory_limit=None,
+    screen_bits=0,
+    screen_count=None,
+    profiler=NO_PROFILER,
+):
+    """Stage 2 (section 3.5)
+
+    Unless verbose, the hypotheses are processed in batches of about
+    memory_limit bytes each (see stage2_candidates). If jobs > 1, the
+    hypotheses are spread across jobs worker processes, which attach to a
+    single copy of the traces in shared memory. The verbose printout is
+    produced only by the sequential run.
+
+    If screen_bits > 0, the hypotheses are first pre-screened on
+    screen_bits bits and screen_count traces (see prescreen). If screen_bits
+    is None, they are pre-screened on screen_depth(sha2) bits, but only if
+    they do not fit in a single batch: otherwise, the full stage 2 drops the
+    wrong hypotheses as early as the pre-screening would.
+    """
 
-    results = []
     if verbose:
         print('\nStage 2 - finding B,C,F,G\n')
-    for stage1_hypo in stage1_hypos:
-        stage2state = Stage2state(sha2, stage1_hypo, data, traces, verbose)
+    if screen_bits is None:
+        batch_size = stage2_batch_size(data, traces, memory_limit)
+        screen_bits = screen_depth(sha2) if len(stage1_hypos) > batch_size else 0
+    if screen_bits > 0:
+        hypo_count = len(stage1_hypos)
+        stage1_hypos = prescreen(
+            sha2,
+            data,
+            traces,
+            stage1_hypos,
+            screen_bits,
+            screen_count,
+            memory_limit,
+            profiler=profiler,
+        )
         if verbose:
             print(
-                (
-                    'Stage 1 hypothesis: '
-                    + sha2.formatter
-                    + ' ' * (sha2.nibble_count * 3 + 3)
-                    + sha2.formatter
-                    + '\n'
-                ).format(
-                    stage1_hypo.prevA,
-                    stage1_hypo.prevE,
-                    stage1_hypo.nextA,
-                    stage1_hypo.nextE,
+                '{} of {} hypotheses passed the pre-screening\n'.format(
+                    len(stage1_hypos), hypo_count
                 )
             )
-        try:
-            for bit_index in range(sha2.bit_count):
-                stage2state.find_bit(bit_index)
-            results.append(stage2state.finalize())
-        except ValueError:
-            if verbose:
-                print('The hypothesis is rejected\n')
+    if jobs > 1 and not verbose and len(stage1_hypos) > 1:
+        bounds = np.linspace(0, len(stage1_hypos), min(4 * jobs, len(stage1_hypos)) + 1)
+        bounds = bounds.astype(int)
+        batches = [stage1_hypos[start:end] for start, end in zip(bounds[:-1], bounds[1:])]
+        # The work of the worker processes is profiled as a single step
+        with profiler.step('2', hypotheses=len(stage1_hypos)):
+            with as_trace_set(data, traces).shared() as shared, ProcessPoolExecutor(
+                jobs, initializer=init_worker, initargs=(warnings.filters,)
+            ) as executor:
+                candidates = [
+                    candidate
+                    for batch in executor.map(
+                        stage2_candidates,
+                        itertools.repeat(sha2),
+                        itertools.repeat(shared),
+                        itertools.repeat(None),
+                        batches,
+                        itertools.repeat(False),
+                        itertools.repeat(memory_limit),
+                    )
+                    for candidate in batch
+                ]
+    else:
+        candidates = stage2_candidates(
+            sha2, data, traces, stage1_hypos, verbose, memory_limit, profiler
+        )
 
-    return results
+    return [candidate for candidate in candidates if candidate is not None]
 
 
-def sha2_attack(sha2, data, traces, second_stage_count, filter_hypo=None, verbose=False):
+def sha2_attack(
+    sha2,
+    data,
+    traces,
+    second_stage_count,
+    filter_hypo=None,
+    verbose=False,
+    chunk_size=None,
+    jobs=1,
+    memory_limit=None,
+    screen_bits=0,
+    screen_count=None,
+    profiler=None,
+):
     """Full attack on SHA256.
 
+    data and traces are either arrays, or a TraceSet and None. If chunk_size
+    is set, the arrays are processed in chunks of chunk_size traces (e.g.,
+    memory-mapped files that do not fit in memory), with the same result.
+    If jobs > 1, stage 2 is performed by jobs worker processes. memory_limit
+    bounds the memory used for a batch of hypotheses at stage 2. If
+    screen_bits > 0, the stage 1 hypotheses are pre-screened on screen_bits
+    bits and screen_count traces before stage 2 (if None, on screen_depth(sha2)
+    bits when they do not fit in a single batch, see stage2). If profiler is set (see
+    sha2_profile.Profiler), every step of the attack is recorded in it.
+
     Returns:
     1) a list of candidates for the secret initial state;
     2) the number of hypotheses found at stage 1.
     """
-    stage1_hypos = stage1(sha2, data, traces, verbose)
+    profiler = profiler or NO_PROFILER
+    trace_set = as_trace_set(data, traces, chunk_size)
+    stage1_hypos = stage1(sha2, trace_set, None, verbose, profiler)
     if filter_hypo:
         stage1_hypos = filter_hypo(stage1_hypos)
     results = stage2(
-        sha2, data[:second_stage_count], traces[:second_stage_count], stage1_hypos, verbose
+        sha2,
+        trace_set.head(second_stage_count),
+        None,
+        stage1_hypos,
+        verbose,
+        jobs,
+        memory_limit,
+        screen_bits,
+        screen_count,
+        profiler,
     )
     if len(results) == 0:
         raise ValueError('{}'.format(sha2.bit_count))
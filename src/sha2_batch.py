@@ -0,0 +1,223 @@
+# Copyright © 2022-present FortifyIQ, Inc. All rights reserved. 
+#
+# This program, sha2-attack, is free software: you can redistribute it and/or modify
+# it under the terms and conditions of FortifyIQ’s free use license (”License”)
+# which is located at
+# https://raw.githubusercontent.com/fortify-iq/sha2-attack/master/LICENSE.
+# This license governs use of the accompanying software. If you use the
+# software, you accept this license. If you do not accept the license, do not
+# use the software.
+#
+# The License permits non-commercial use, but does not permit commercial use or
+# resale. This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY OR RIGHT TO ECONOMIC DAMAGES; without even the implied
+# warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+#
+# If you have any questions regarding the software of the license, please
+# contact kreimer@fortifyiq.com
+
+import numpy as np
+
+from sha2_attack import partition_averages, Stage1state, Stage2batch
+from sha2_bit_planes import batch_bit_planes, batch_partition_sums
+from sha2_trace_set import TraceSet
+
+
+def run_lockstep(steps, averages):
+    """Perform several decisions (see run_steps) at once. steps is a
+    dictionary {key: generator}. In every round, the partitions requested by
+    all the unfinished decisions are passed together to averages(keys,
+    partitions), which returns their averages in the same order.
+
+    Returns a dictionary {key: ValueError} of the failed decisions.
+    """
+
+    errors = {}
+    partitions = {}
+
+    def advance(key, value):
+        try:
+            partitions[key] = steps[key].send(value)
+        except StopIteration:
+            pass
+        except ValueError as error:
+            errors[key] = error
+
+    for key in steps:
+        advance(key, None)
+    while partitions:
+        keys = list(partitions)
+        requested = [partitions.pop(key) for key in keys]
+        for key, value in zip(keys, averages(keys, requested)):
+            advance(key, value)
+    return errors
+
+
+# Partitions of more (hypotheses x traces) cells than this are not worth
+# batching, and are reduced separately
+BATCH_CELLS = 1 << 12
+
+
+def batch_partition_averages(requests):
+    """Averages of a list of partitions (trace_set, index, partition) of
+    different trace sets (see partition_averages).
+
+    The partitions described for the bit-plane index are reduced together
+    (see batch_partition_sums). The class indices of the other partitions of
+    small single-chunk trace sets are offset into a common range, so that all
+    of them are counted and summed by one bincount.
+    """
+
+    results = [None] * len(requests)
+    planes = [
+        number
+        for number, (_, index, partition) in enumerate(requests)
+        if index is not None and partition.fields is not None
+    ]
+    if planes:
+        plane_sums = batch_partition_sums(
+            [
+                (index, partition.fields, partition.classes, partition.class_count)
+                for _, index, partition in (requests[number] for number in planes)
+            ]
+        )
+        for number, (sums, counts) in zip(planes, plane_sums):
+            results[number] = sums / counts
+
+    numbers, classes, weights, offsets = [], [], [], [0]
+    for number, (trace_set, index, partition) in enumerate(requests):
+        if results[number] is not None:
+            continue
+        if trace_set.chunk_size < len(trace_set):
+            results[number] = partition_averages(trace_set, None, partition)
+            continue
+        data, traces = next(trace_set.chunks())
+        partition_classes = partition.classify(data)
+        if partition_classes.size > BATCH_CELLS:
+            sums, counts = trace_set.partition_sums(
+                lambda data: partition_classes, partition.class_count, partition.column
+            )
+            results[number] = sums / counts
+            continue
+        # Every partition has one more class for the ignored traces
+        partition_classes = np.minimum(partition_classes.astype(np.intp), partition.class_count)
+        partition_weights = traces[:, partition.column]
+        if partition_classes.ndim > 1:
+            partition_weights = np.broadcast_to(partition_weights, partition_classes.shape)
+        numbers.append(number)
+        classes.append((partition_classes + offsets[-1]).ravel())
+        weights.append(partition_weights.astype(float).ravel())
+        offsets.append(offsets[-1] + partition.class_count + 1)
+    if numbers:
+        classes = np.concatenate(classes)
+        sums = np.bincount(classes, np.concatenate(weights), offsets[-1])
+        counts = np.bincount(classes, minlength=offsets[-1])
+        for number, start, end in zip(numbers, offsets, offsets[1:]):
+            results[number] = sums[start:end - 1] / counts[start:end - 1]
+    return results
+
+
+def batch_attack(sha2, data, traces, second_stage_count, filters=None, memory_limit=None):
+    """sha2_attack on the traces of several experiments at once.
+
+    data and traces are stacks of the inputs and traces of E experiments
+    (E x N x 2, see generate_trace_batch). Both stages are performed for all
+    the experiments in lockstep: at every step, the partitions of all the
+    experiments (and of all their hypotheses at stage 2) are reduced
+    together (see batch_partition_averages), which saves the overhead of the
+    NumPy calls of the separate attacks. filters, if set, is a list of
+    filter_hypo functions (see sha2_attack), one per experiment.
+
+    Returns a list with, for every experiment:
+    1) the list of candidates for the secret initial state;
+    2) the number of hypotheses found at stage 1;
+    3) the bit index of the failure (see sha2_attack), or None.
+    The outcome of every experiment is the same as that of sha2_attack.
+    """
+
+    trace_sets = [TraceSet(*experiment) for experiment in zip(data, traces)]
+    failures = [None] * len(trace_sets)
+    indices = batch_bit_planes(sha2, data, traces) or [None] * len(trace_sets)
+
+    def fail(errors):
+        for number, error in errors.items():
+            failures[number] = int('{}'.format(error))
+
+    # Stage 1
+    states = [
+        Stage1state(sha2, trace_set, None, False, index=index)
+        for trace_set, index in zip(trace_sets, indices)
+    ]
+    for bit_index in range(sha2.bit_count - 1):
+        fail(
+            run_lockstep(
+                {
+                    number: state.bit_steps(bit_index)
+                    for number, state in enumerate(states)
+                    if failures[number] is None
+                },
+                lambda keys, partitions: batch_partition_averages(
+                    [
+                        (trace_sets[key], states[key].index, partition)
+                        for key, partition in zip(keys, partitions)
+                    ]
+                ),
+            )
+        )
+    stage1_hypos = [None] * len(trace_sets)
+    for number, state in enumerate(states):
+        if failures[number] is None:
+            try:
+                stage1_hypos[number] = state.finalize()
+                if filters:
+                    stage1_hypos[number] = filters[number](stage1_hypos[number])
+            except ValueError as error:
+                fail({number: error})
+
+    # Stage 2, in batches of hypotheses of up to about memory_limit bytes in
+    # total, which are performed in lockstep
+    memory_limit = memory_limit or Stage2batch.memory_limit
+    cell_limit = max(1, memory_limit // Stage2batch.bytes_per_cell)
+    groups = [[]]
+    cell_count = 0
+    for number, hypos in enumerate(stage1_hypos):
+        if failures[number] is None:
+            trace_set = trace_sets[number].head(second_stage_count)
+            batch_size = max(1, cell_limit // max(len(trace_set), 1))
+            for start in range(0, len(hypos), batch_size):
+                hypo_batch = hypos[start:start + batch_size]
+                cell_count += len(hypo_batch) * len(trace_set)
+                if cell_count > cell_limit and groups[-1]:
+                    groups.append([])
+                    cell_count = len(hypo_batch) * len(trace_set)
+                groups[-1].append((number, hypo_batch, trace_set))
+    candidates = [[] for _ in trace_sets]
+    for group in groups:
+        batches = [
+            Stage2batch(sha2, hypo_batch, trace_set, None) for _, hypo_batch, trace_set in group
+        ]
+        for bit_index in range(sha2.bit_count):
+            run_lockstep(
+                {
+                    key: batch.bit_steps(bit_index)
+                    for key, batch in enumerate(batches)
+                    if len(batch.indices) > 0
+                },
+                lambda keys, partitions: batch_partition_averages(
+                    [
+                        (batches[key].trace_set, None, partition)
+                        for key, partition in zip(keys, partitions)
+                    ]
+                ),
+            )
+        for (number, _, _), batch in zip(group, batches):
+            candidates[number] += batch.finalize()[1]
+
+    outcomes = []
+    for number, hypos in enumerate(stage1_hypos):
+        if failures[number] is None and not candidates[number]:
+            failures[number] = sha2.bit_count
+        outcomes.append(
+            (candidates[number], 0 if hypos is None else len(hypos), failures[number])
+        )
+    return outcomes
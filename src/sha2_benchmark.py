@@ -0,0 +1,350 @@
+# Copyright © 2022-present FortifyIQ, Inc. All rights reserved. 
+#
+# This program, sha2-attack, is free software: you can redistribute it and/or modify
+# it under the terms and conditions of FortifyIQ’s free use license (”License”)
+# which is located at
+# https://raw.githubusercontent.com/fortify-iq/sha2-attack/master/LICENSE.
+# This license governs use of the accompanying software. If you use the
+# software, you accept this license. If you do not accept the license, do not
+# use the software.
+#
+# The License permits non-commercial use, but does not permit commercial use or
+# resale. This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY OR RIGHT TO ECONOMIC DAMAGES; without even the implied
+# warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+#
+# If you have any questions regarding the software of the license, please
+# contact kreimer@fortifyiq.com
+
+import argparse
+import json
+import platform
+import sys
+import time
+import tracemalloc
+import warnings
+
+import numpy as np
+
+from sha2 import DEFAULT_POPCOUNT, POPCOUNT_BACKENDS, set_popcount, Sha256, Sha512
+from sha2_attack import stage1, stage2, Stage1hypo
+from sha2_trace_generation import generate_traces
+
+
+def measure(function, repeat_count):
+    """Call function repeat_count times, and then once more with tracemalloc.
+
+    Returns:
+    1) the wall time of the fastest call, in seconds;
+    2) the peak memory allocated during the traced call, in bytes;
+    3) the result of the last call.
+    """
+
+    best = float('inf')
+    for _ in range(repeat_count):
+        start = time.perf_counter()
+        function()
+        best = min(best, time.perf_counter() - start)
+    tracemalloc.start()
+    try:
+        result = function()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return best, peak, result
+
+
+def record(benchmark, sha2, count, noise, seconds, peak, **extra):
+    return dict(
+        benchmark=benchmark,
+        sha=sha2.__name__,
+        count=count,
+        noise=noise,
+        seconds=seconds,
+        peak_bytes=peak,
+        per_second=count / seconds if seconds else None,
+        **extra,
+    )
+
+
+def benchmark_hd(sha2, count, repeat_count=3, seed=0):
+    """Records of sha2.hd on arrays of count random words for every popcount
+    backend (the count is in words)"""
+
+    state = np.random.RandomState(seed)
+    x, y = state.randint(1 << sha2.bit_count, size=(2, count), dtype=sha2.dtype)
+    records = []
+    try:
+        for backend in POPCOUNT_BACKENDS:
+            set_popcount(backend)
+            seconds, peak, _ = measure(lambda: sha2.hd(x, y), repeat_count)
+            records.append(record('hd', sha2, count, None, seconds, peak, backend=backend))
+    finally:
+        set_popcount(DEFAULT_POPCOUNT)
+    return records
+
+
+def benchmark_compress(sha2, count, repeat_count=3, seed=0):
+    """Record of sha2.compress on a batch of count random blocks (the count
+    is in blocks)"""
+
+    state = np.random.RandomState(seed)
+    iv = state.randint(1 << sha2.bit_count, size=8, dtype=sha2.dtype)
+    blocks = state.randint(1 << sha2.bit_count, size=(16, count), dtype=sha2.dtype)
+    seconds, peak, _ = measure(lambda: sha2().compress(blocks.copy(), iv), repeat_count)
+    return record('compress', sha2, count, None, seconds, peak)
+
+
+def attempt(function):
+    """function that returns the ValueError raised by function (a failure of
+    the attack at a bit) instead of raising it"""
+
+    def attempted():
+        try:
+            return function()
+        except ValueError as error_index:
+            return error_index
+
+    return attempted
+
+
+def benchmark_attack(sha2, trace_count, noise, repeat_count=3, seed=0):
+    """Records of generate_traces, stage1 and stage2 (with the correct
+    hypothesis only, and with all the hypotheses) on trace_count traces.
+
+    If stage 1 fails, its time until the failure is recorded together with the
+    bit, and stage 2 is measured only with the correct hypothesis (derived
+    from the initial state).
+    """
+
+    seconds, peak, (data, traces, iv) = measure(
+        lambda: generate_traces(sha2, trace_count, seed, noise), repeat_count
+    )
+    records = [record('generate', sha2, trace_count, noise, seconds, peak)]
+    seconds, peak, stage1_hypos = measure(
+        attempt(lambda: stage1(sha2, data, traces, False)), repeat_count
+    )
+    if isinstance(stage1_hypos, ValueError):
+        records.append(
+            record(
+                'stage1', sha2, trace_count, noise, seconds, peak, failure=int(str(stage1_hypos))
+            )
+        )
+        stage1_hypos = None
+    else:
+        records.append(
+            record('stage1', sha2, trace_count, noise, seconds, peak, hypotheses=len(stage1_hypos))
+        )
+    correct = Stage1hypo(iv[8], iv[0], iv[9], iv[4])
+    benchmarks = [('stage2-filtered', [correct])]
+    if stage1_hypos is not None:
+        benchmarks.append(('stage2', stage1_hypos))
+    for benchmark, hypos in benchmarks:
+        seconds, peak, candidates = measure(
+            attempt(lambda: stage2(sha2, data, traces, hypos, False)), repeat_count
+        )
+        if isinstance(candidates, ValueError):
+            outcome = dict(failure=int(str(candidates)))
+        else:
+            outcome = dict(candidates=len(candidates))
+        records.append(
+            record(
+                benchmark,
+                sha2,
+                trace_count,
+                noise,
+                seconds,
+                peak,
+                hypotheses=len(hypos),
+                **outcome,
+            )
+        )
+    return records
+
+
+def run_suite(shas, trace_counts, noises, repeat_count=3, seed=0, progress=None):
+    """All the benchmarks for every sha, trace count and noise level.
+    progress, if set, is called with every record when it is ready."""
+
+    records = []
+    for sha2 in shas:
+        for trace_count in trace_counts:
+            new_records = benchmark_hd(sha2, trace_count, repeat_count, seed)
+            new_records.append(benchmark_compress(sha2, trace_count, repeat_count, seed))
+            for noise in noises:
+                new_records += benchmark_attack(sha2, trace_count, noise, repeat_count, seed)
+            for new_record in new_records:
+                if progress:
+                    progress(new_record)
+                records.append(new_record)
+    return records
+
+
+def key(record):
+    """The parameters that identify a measurement across runs"""
+    return record['benchmark'], record['sha'], record['count'], record['noise'], \
+        record.get('backend')
+
+
+def compare(records, baseline_records, tolerance):
+    """Ratios of the wall times to those of the matching baseline records.
+
+    Returns:
+    1) a list of (record, ratio, regression) for the records that have a
+    comparable match, where regression is True if the ratio exceeds
+    1 + tolerance;
+    2) a list of (record, reason) for the records that are not compared.
+    """
+
+    baseline = {key(record): record for record in baseline_records}
+    comparison, skipped = [], []
+    for record in records:
+        match = baseline.get(key(record))
+        if match is None:
+            skipped.append((record, 'not in the baseline'))
+        elif not record['seconds'] or not match['seconds']:
+            skipped.append((record, 'not measured'))
+        elif record.get('failure') != match.get('failure'):
+            # The time until a failure is not comparable with that of a
+            # complete run, or of a failure at another bit
+            skipped.append(
+                (
+                    record,
+                    'failure at bit {} vs {} in the baseline'.format(
+                        record.get('failure'), match.get('failure')
+                    ),
+                )
+            )
+        else:
+            ratio = record['seconds'] / match['seconds']
+            comparison.append((record, ratio, ratio > 1 + tolerance))
+    return comparison, skipped
+
+
+def format_record(record):
+    parameters = '{:16s} {:6s} {:9d} {:>5s}'.format(
+        record['benchmark'] + (' ({})'.format(record['backend']) if 'backend' in record else ''),
+        record['sha'],
+        record['count'],
+        '' if record['noise'] is None else '{:.2f}'.format(record['noise']),
+    )
+    return parameters + ' {:10.4f} s {:10.1f} MB {:14,.0f} /s{}'.format(
+        record['seconds'],
+        record['peak_bytes'] / (1 << 20),
+        record['per_second'],
+        '  Failure: bit {}'.format(record['failure']) if 'failure' in record else '',
+    )
+
+
+def parse():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '-b',
+        '--bit-count',
+        type=int,
+        nargs='+',
+        choices=[32, 64],
+        default=[32, 64],
+        help='Bit sizes of words - 32 for SHA256, 64 for SHA512 (both by default)',
+    )
+    parser.add_argument(
+        '-t',
+        '--trace-count-log',
+        type=int,
+        nargs='+',
+        default=[12, 16, 20],
+        help='Binary logarithms of the numbers of traces (12 16 20 by default)',
+    )
+    parser.add_argument(
+        '-n',
+        '--noise',
+        type=float,
+        nargs='+',
+        default=[0.0],
+        help='Standard deviations of the noise (0 by default)',
+    )
+    parser.add_argument(
+        '-r',
+        '--repeat-count',
+        type=int,
+        default=3,
+        help='Number of timed runs of every benchmark, of which the fastest is reported '
+        '(3 by default)',
+    )
+    parser.add_argument(
+        '-s',
+        '--seed',
+        type=int,
+        default=0,
+        help='Random seed for the inputs of the benchmarks (0 by default)',
+    )
+    parser.add_argument(
+        '-o',
+        '--output',
+        default=None,
+        help='JSON file to write the results to',
+    )
+    parser.add_argument(
+        '--baseline',
+        default=None,
+        help='JSON file written by an earlier run to compare the results with',
+    )
+    parser.add_argument(
+        '--tolerance',
+        type=float,
+        default=0.1,
+        help='Relative slowdown with respect to the baseline that is reported as a regression '
+        '(0.1 by default)',
+    )
+    args = parser.parse_args()
+    return (
+        [Sha256 if bit_count == 32 else Sha512 for bit_count in args.bit_count],
+        [1 << log for log in args.trace_count_log],
+        [noise or None for noise in args.noise],
+        args.repeat_count,
+        args.seed,
+        args.output,
+        args.baseline,
+        args.tolerance,
+    )
+
+
+if __name__ == '__main__':
+    shas, trace_counts, noises, repeat_count, seed, output, baseline, tolerance = parse()
+    # Suppress expected overflows in addition and subtraction
+    warnings.filterwarnings('ignore', category=RuntimeWarning)
+    records = run_suite(
+        shas,
+        trace_counts,
+        noises,
+        repeat_count,
+        seed,
+        lambda record: print(format_record(record), flush=True),
+    )
+    if output:
+        with open(output, 'w') as file:
+            json.dump(
+                {
+                    'python': platform.python_version(),
+                    'numpy': np.__version__,
+                    'machine': platform.machine(),
+                    'popcount': DEFAULT_POPCOUNT,
+                    'records': records,
+                },
+                file,
+                indent=1,
+            )
+    if baseline:
+        with open(baseline) as file:
+            comparison, skipped = compare(records, json.load(file)['records'], tolerance)
+        print('\nComparison with {}:'.format(baseline))
+        for record, ratio, regression in comparison:
+            print(
+                '{:.40s} {:6.2f}x{}'.format(
+                    format_record(record), ratio, '  REGRESSION' if regression else ''
+                )
+            )
+        for record, reason in skipped:
+            print('{:.40s}  not compared: {}'.format(format_record(record), reason))
+        if any(regression for _, _, regression in comparison):
+            sys.exit(1)
@@ -0,0 +1,217 @@
+# Copyright © 2022-present FortifyIQ, Inc. All rights reserved. 
+#
+# This program, sha2-attack, is free software: you can redistribute it and/or modify
+# it under the terms and conditions of FortifyIQ’s free use license (”License”)
+# which is located at
+# https://raw.githubusercontent.com/fortify-iq/sha2-attack/master/LICENSE.
+# This license governs use of the accompanying software. If you use the
+# software, you accept this license. If you do not accept the license, do not
+# use the software.
+#
+# The License permits non-commercial use, but does not permit commercial use or
+# resale. This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY OR RIGHT TO ECONOMIC DAMAGES; without even the implied
+# warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+#
+# If you have any questions regarding the software of the license, please
+# contact kreimer@fortifyiq.com
+
+from collections import OrderedDict
+
+import numpy as np
+
+from sha2 import Sha512
+from sha2_threads import map_blocks, sum_blocks
+
+# Number of traces whose bits are transposed at a time
+BLOCK_SIZE = 1 << 16
+
+
+def pack_bits(values, bit_count):
+    """The bit_count least significant bit-planes of a vector of unsigned
+    integers, as a (bit_count x ceil(N / 64)) array of uint64 words. Bit t % 64
+    of word t // 64 of plane i is bit i of values[t]."""
+
+    word_count = -(-len(values) // 64)
+    planes = np.zeros((bit_count, word_count), dtype=np.uint64)
+
+    def pack_block(block):
+        values_block = values[block]
+        padded = np.zeros(
+            -(-len(values_block) // 64) * 64, dtype=values_block.dtype.newbyteorder('<')
+        )
+        padded[:len(values_block)] = values_block
+        bits = np.unpackbits(padded.view(np.uint8).reshape(len(padded), -1), 1, bitorder='little')
+        packed = np.packbits(bits[:, :bit_count], 0, bitorder='little')
+        planes[:, block.start // 64:(block.start + len(padded)) // 64] = (
+            np.ascontiguousarray(packed.T).view('<u8')
+        )
+
+    # The blocks write disjoint words of the planes
+    map_blocks(pack_block, len(values), BLOCK_SIZE)
+    return planes
+
+
+class BitPlaneIndex:
+    """Packed bit-planes of the first input word W_0 and of the first trace
+    sample, for the partitions of stage 1 (section 3.4).
+
+    The classes of stage 1 are defined by a few bits of W_0 + x for known
+    values x. The bits of the sum are computed by word-level bit operations
+    on the planes of W_0 and on the plane of the carry, which is extended one
+    bit at a time as the bits of x become known, instead of full-width
+    integer additions per trace. The per-class counts and sums of the traces
+    are then popcounts of the class masks and of the masks of the trace
+    bit-planes, so the traces must be integers (i.e., noiseless).
+    """
+
+    # Maximum number of cached carry planes
+    carry_cache_size = 256
+
+    def __init__(self, bit_count, words, samples, valid):
+        """words and samples are the bit-planes of W_0 and of the first trace
+        samples, and valid is the mask of the actual traces among the padded
+        ones (see pack_bits)"""
+
+        self.bit_count = bit_count
+        self.words = words
+        self.samples = samples
+        self.valid = valid
+        # {(x mod 2^bit_index, bit_index): carry into bit_index of W_0 + x}
+        self.carries = OrderedDict()
+
+    @classmethod
+    def build(cls, sha2, data, traces):
+        """The index of the inputs data and the integer traces"""
+        samples = traces[:, 0]
+        return cls(
+            sha2.bit_count,
+            pack_bits(data[:, 0], sha2.bit_count),
+            pack_bits(samples, int(samples.max()).bit_length() if len(samples) else 0),
+            pack_bits(np.ones(len(data), dtype=np.uint8), 1)[0],
+        )
+
+    def carry(self, addend, bit_index):
+        """Plane of the carry into bit bit_index of W_0 + addend"""
+
+        addend &= (1 << bit_index) - 1
+        # Resume from the longest cached carry of the same low bits
+        start, carry = 0, np.zeros_like(self.valid)
+        for index in range(bit_index, 0, -1):
+            cached = self.carries.get((addend & ((1 << index) - 1), index))
+            if cached is not None:
+                start, carry = index, cached
+                break
+        for index in range(start, bit_index):
+            # The carry is the majority of the bit of W_0, the bit of addend
+            # and the previous carry
+            if addend >> index & 1:
+                carry = self.words[index] | carry
+            else:
+                carry = self.words[index] & carry
+            self.carries[addend & ((2 << index) - 1), index + 1] = carry
+            while len(self.carries) > self.carry_cache_size:
+                self.carries.popitem(last=False)
+        return carry
+
+    def sum_bits(self, addend, start, width):
+        """Planes of bits start, ..., start + width - 1 of W_0 + addend"""
+
+        assert start + width <= self.bit_count
+        carry = self.carry(addend, start)
+        planes = []
+        for index in range(start, start + width):
+            word = self.words[index]
+            if addend >> index & 1:
+                planes.append(~(word ^ carry))
+                carry = word | carry
+            else:
+                planes.append(word ^ carry)
+                carry = word & carry
+        return planes
+
+    def masks(self, fields):
+        """Masks of the traces of every value of the fields (see
+        partition_sums), as a (values x words) array"""
+
+        masks = self.valid[None]
+        for addend, start, width in fields:
+            for plane in self.sum_bits(int(addend), start, width):
+                masks = np.concatenate((masks & ~plane, masks & plane))
+        return masks
+
+    def partition_sums(self, fields, classes, class_count):
+        """Sum of the first trace samples and number of traces in every class
+        of a partition (see TraceSet.partition_sums).
+
+        fields is a list of (addend, start, width), each standing for bits
+        start, ..., start + width - 1 of W_0 + addend. The value of a trace is
+        the concatenation of the fields, the first field in the least
+        significant bits, and its class index is classes[value] (the value
+        itself if classes is None). Traces whose class index is class_count
+        or greater are ignored.
+        """
+        return batch_partition_sums([(self, fields, classes, class_count)])[0]
+
+
+def batch_bit_planes(sha2, data, traces):
+    """BitPlaneIndex.build for the stacks of the inputs and traces of several
+    experiments (E x N x 2), packed at once. Returns None if the traces are
+    not integers or N is not a multiple of 64."""
+
+    experiment_count, trace_count = data.shape[:2]
+    if traces.dtype.kind not in 'ui' or trace_count % 64 or trace_count == 0:
+        return None
+    words = pack_bits(data[..., 0].ravel(), sha2.bit_count)
+    samples = traces[..., 0].ravel()
+    samples = pack_bits(samples, int(samples.max()).bit_length())
+    valid = np.full(trace_count // 64, ~np.uint64(0))
+    return [
+        BitPlaneIndex(sha2.bit_count, words[:, part], samples[:, part], valid)
+        for part in (
+            slice(number * len(valid), (number + 1) * len(valid))
+            for number in range(experiment_count)
+        )
+    ]
+
+
+def batch_partition_sums(partitions):
+    """partition_sums for a list of partitions (index, fields, classes,
+    class_count) of indices of the same number of traces (e.g., of the trace
+    sets of several experiments), with a single popcount per trace bit-plane
+    for all of them"""
+
+    masks = [index.masks(fields) for index, fields, _, _ in partitions]
+    owners = np.repeat(np.arange(len(partitions)), [len(mask) for mask in masks])
+    masks = np.concatenate(masks)
+
+    def sum_block(block):
+        block_masks = masks[:, block]
+        value_sums = np.zeros(len(masks), dtype=np.uint64)
+        for bit in range(max(len(index.samples) for index, _, _, _ in partitions)):
+            planes = np.array(
+                [
+                    index.samples[bit, block]
+                    if bit < len(index.samples)
+                    else np.zeros_like(index.valid[block])
+                    for index, _, _, _ in partitions
+                ]
+            )
+            value_sums += Sha512.popcount(block_masks & planes[owners]).sum(1) << np.uint64(bit)
+        return value_sums, Sha512.popcount(block_masks).sum(1)
+
+    # The words are summed by blocks of BLOCK_SIZE traces
+    value_sums, value_counts = sum_blocks(sum_block, masks.shape[1], BLOCK_SIZE // 64)
+    results = []
+    for owner, (_, _, classes, class_count) in enumerate(partitions):
+        values = owners == owner
+        indices = np.arange(np.count_nonzero(values)) if classes is None else classes
+        results.append(
+            (
+                np.bincount(indices, value_sums[values], class_count)[:class_count],
+                np.bincount(indices, value_counts[values], class_count)[:class_count].astype(
+                    np.int64
+                ),
+            )
+        )
+    return results
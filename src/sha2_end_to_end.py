@@ -16,79 +16,551 @@
 # If you have any questions regarding the software of the license, please
 # contact kreimer@fortifyiq.com
 
+import contextlib
+import functools
+import itertools
+import math
 import random
-from sha2_attack import sha2_attack, Stage1hypo
-from sha2_trace_generation import generate_traces
+import statistics
+import warnings
+from concurrent.futures import ProcessPoolExecutor
 
+from sha2_attack import init_worker, sha2_attack, Stage1hypo
+from sha2_trace_file import read_trace_file, write_trace_file
+from sha2_batch import batch_attack
+from sha2_trace_generation import (
+    generate_round_traces,
+    generate_trace_batch,
+    generate_traces,
+    TraceStream,
+)
+from sha2_trace_set import PrefixStatistics, TraceSet
+from sha2_verification import verify_candidates
 
-def end_to_end_attack(
+
+def run_experiment(
     sha2,
     trace_count,
     second_stage_count,
     noise,
-    experiment_count,
-    seed=None,
+    seed,
+    filter_hypo=True,
+    verbose=False,
+    chunk_size=None,
+    stage2_jobs=1,
+    memory_limit=None,
+    screen_bits=0,
+    screen_count=None,
+    stream=False,
+    load_traces=None,
+    save_traces=None,
+    single=False,
+    profiler=None,
+    verify_count=0,
+    verify_rounds=8,
+):
+    """Generate the traces with the given seed and perform the attack.
+
+    If stream, the traces are not held in memory, but generated anew in
+    chunks of chunk_size traces on every pass of the attack. If load_traces,
+    the traces are not generated, but read from this trace set file. If
+    save_traces, the traces are written to this trace set file. If single,
+    noisy traces are generated as float32 rather than float64. If profiler
+    is set, the steps of the attack are recorded in it (see sha2_attack). If
+    verify_count is set, the candidates are verified on verify_count traces
+    of verify_rounds rounds (see attack_traces).
+
+    Returns:
+    1) 1 if the attack succeeded, otherwise 0;
+    2) the number of correctly found least significant bits;
+    3) the line to report for the experiment, or None.
+    """
+
+    # Generate the traces
+    if load_traces:
+        data = read_trace_file(load_traces, chunk_size)
+        traces, iv = None, data.iv
+    elif stream:
+        data = TraceStream(sha2, trace_count, seed, noise, chunk_size, single)
+        traces, iv = None, data.iv
+    else:
+        data, traces, iv = generate_traces(sha2, trace_count, seed, noise, single)
+    if save_traces:
+        write_trace_file(save_traces, sha2, data, traces, iv, seed=seed, noise=noise)
+    if verbose:
+        print(
+            '\n'
+            + ' ' * 20
+            + (' ' * sha2.nibble_count).join(('A', 'B', 'C', 'D', 'E', 'F', 'G', 'H'))
+            + ' ' * (sha2.nibble_count + 2)
+            + 'DeltaA   DeltaE'
+        )
+        print(
+            ('The initial state:  ' + sha2.formatter * 8 + '  ' + sha2.formatter * 2).format(
+                *iv
+            )
+        )
+    return attack_traces(
+        sha2,
+        data,
+        traces,
+        iv,
+        second_stage_count,
+        seed,
+        filter_hypo,
+        verbose,
+        chunk_size,
+        stage2_jobs,
+        memory_limit,
+        screen_bits,
+        screen_count,
+        profiler,
+        verify_count,
+        verify_rounds,
+        noise,
+    )
+
+
+def attack_traces(
+    sha2,
+    data,
+    traces,
+    iv,
+    second_stage_count,
+    seed,
     filter_hypo=True,
     verbose=False,
+    chunk_size=None,
+    stage2_jobs=1,
+    memory_limit=None,
+    screen_bits=0,
+    screen_count=None,
+    profiler=None,
+    verify_count=0,
+    verify_rounds=8,
+    noise=None,
 ):
+    """Perform the attack on the traces generated with the given seed for the
+    secret initial state iv, and evaluate the result (see run_experiment).
+
+    If verify_count is set, verify_count further traces of the first
+    verify_rounds rounds of random known blocks are generated with the given
+    noise, the candidates are ranked on them (see verify_candidates), and
+    only the best one is kept.
+    """
+
+    try:
+        # Perform the attack
+        results, count = sha2_attack(
+            sha2,
+            data,
+            traces,
+            second_stage_count,
+            hypotheses_filter(sha2, iv) if filter_hypo else None,
+            verbose,
+            chunk_size,
+            stage2_jobs,
+            memory_limit,
+            screen_bits,
+            screen_count,
+            profiler,
+        )
+        if verify_count:
+            # The verification traces are independent of the traces of the
+            # attack
+            blocks, round_traces = generate_round_traces(
+                sha2,
+                iv,
+                verify_count,
+                None if seed is None else [seed % (1 << 32), 1],
+                noise,
+                verify_rounds,
+            )
+            results, correlations = verify_candidates(sha2, blocks, round_traces, results)
+            if verbose:
+                print(
+                    '{} candidates remain after the verification, the best correlation is '
+                    '{:.3f}'.format(len(results), correlations[0])
+                )
+            results = results[:1]
+        # Print the results
+        if verbose:
+            print('The remaining candidates:')
+            for result in results:
+                print(
+                    (' ' * 20 + sha2.formatter * 8 + '  {}').format(
+                        *result, 'correct' if result == iv[:8] else 'wrong'
+                    )
+                )
+    except ValueError as error_index:
+        if verbose:
+            print('Failure: bit {}'.format(error_index))
+        return experiment_outcome(
+            sha2, iv, seed, None, None, int('{}'.format(error_index)), verbose or filter_hypo
+        )
+    return experiment_outcome(sha2, iv, seed, results, count, None, verbose or filter_hypo)
+
+
+def hypotheses_filter(sha2, iv):
+    """filter_hypo function (see sha2_attack) that keeps only the correct
+    stage 1 hypothesis for the initial state iv"""
+
     def filter_hypotheses(stage1_hypos):
         hypo = Stage1hypo(iv[8], iv[0], iv[9], iv[4])
         if hypo in stage1_hypos:
             return [hypo]
         raise ValueError('{}'.format(sha2.bit_count))
 
-    result_success_count, lsb_success_count = 0, 0
+    return filter_hypotheses
+
+
+def experiment_outcome(sha2, iv, seed, results, count, failure, quiet):
+    """The outcome of run_experiment for the candidates results out of count
+    stage 1 hypotheses, or for the failure at bit failure. Unless quiet, the
+    outcome has a line to report."""
+
+    if failure is not None:
+        return 0, failure, None if quiet else '{:8d} Failure: bit {}'.format(seed, failure)
+    # Errors in stage 2 are exceptionally rare. If one happens, we count only
+    # one correct word although in fact it may be more
+    lsb_success_count = 2 * sha2.bit_count if iv[:8] in results else sha2.bit_count
+    line = None if quiet else '{:8d} Success {:5d} {:3d}'.format(seed, count, len(results))
+    return 1, lsb_success_count, line
+
+
+def run_experiment_batch(
+    sha2,
+    trace_count,
+    second_stage_count,
+    noise,
+    seeds,
+    filter_hypo=True,
+    memory_limit=None,
+    single=False,
+):
+    """run_experiment for every one of seeds at once, with the traces of all
+    the experiments generated by generate_trace_batch and attacked by
+    batch_attack. Returns the outcomes of run_experiment in the order of the
+    seeds."""
+
+    data, traces, ivs = generate_trace_batch(sha2, trace_count, seeds, noise, single)
+    outcomes = batch_attack(
+        sha2,
+        data,
+        traces,
+        second_stage_count,
+        [hypotheses_filter(sha2, iv) for iv in ivs] if filter_hypo else None,
+        memory_limit,
+    )
+    return [
+        experiment_outcome(sha2, iv, seed, results, count, failure, filter_hypo)
+        for iv, seed, (results, count, failure) in zip(ivs, seeds, outcomes)
+    ]
+
+
+def run_nested_experiment(
+    sha2,
+    trace_counts,
+    noise,
+    seed,
+    filter_hypo=True,
+    chunk_size=None,
+    stage2_jobs=1,
+    memory_limit=None,
+    screen_bits=0,
+    screen_count=None,
+    single=False,
+):
+    """Generate the traces for the greatest of trace_counts with the given
+    seed, and attack its prefixes of trace_counts traces in ascending order.
+
+    The partition statistics are extended from every prefix to the next one
+    (see PrefixStatistics) rather than recomputed, so that the experiment
+    costs about as much as the attack on the longest prefix. Every prefix is
+    used for both stages. Without noise, the outcomes are the same as those
+    of run_experiment for every trace count. With noise, the noise of a
+    prefix differs from that generated by run_experiment for the same seed.
+
+    Returns the outcomes of run_experiment for trace_counts in ascending
+    order.
+    """
+
+    data, traces, iv = generate_traces(sha2, max(trace_counts), seed, noise, single)
+    statistics = PrefixStatistics(TraceSet(data, traces, chunk_size))
+    outcomes = []
+    for trace_count in sorted(trace_counts):
+        outcomes.append(
+            attack_traces(
+                sha2,
+                statistics.prefix(trace_count),
+                None,
+                iv,
+                trace_count,
+                seed,
+                filter_hypo,
+                chunk_size=chunk_size,
+                stage2_jobs=stage2_jobs,
+                memory_limit=memory_limit,
+                screen_bits=screen_bits,
+                screen_count=screen_count,
+            )
+        )
+        # Only the partitions of the last attack can be extended by the next
+        # one, so that the cache does not grow with the number of prefixes
+        statistics.discard_unused()
+    return outcomes
+
+
+def nested_end_to_end_attack(
+    sha2,
+    trace_counts,
+    noise,
+    experiment_count,
+    seed=None,
+    filter_hypo=True,
+    chunk_size=None,
+    jobs=1,
+    confidence=0.95,
+    reports=None,
+    **options,
+):
+    """Perform experiment_count experiments with seeds seed, seed + 1, ...
+    for every one of trace_counts, attacking the prefixes of a single trace
+    set per seed (see run_nested_experiment). The options are passed to
+    run_nested_experiment. If reports is a list, a report for every one of
+    trace_counts in ascending order is appended to it (see
+    end_to_end_attack).
+
+    Returns the estimations of metrics M1, M2 (in percents) for trace_counts
+    in ascending order.
+    """
+
     if seed is None:
         seed = random.getrandbits(32)
-    for i in range(experiment_count):
-        # Generate the traces
-        data, traces, iv = generate_traces(sha2, trace_count, seed + i, noise)
-        if verbose:
-            print(
-                '\n'
-                + ' ' * 20
-                + (' ' * sha2.nibble_count).join(('A', 'B', 'C', 'D', 'E', 'F', 'G', 'H'))
-                + ' ' * (sha2.nibble_count + 2)
-                + 'DeltaA   DeltaE'
+    experiment = functools.partial(
+        run_nested_experiment,
+        sha2,
+        trace_counts,
+        noise,
+        filter_hypo=filter_hypo,
+        chunk_size=chunk_size,
+        **options,
+    )
+    seeds = range(seed, seed + experiment_count)
+    result_success_counts = [0] * len(trace_counts)
+    lsb_success_counts = [0] * len(trace_counts)
+    lsb_square_sums = [0] * len(trace_counts)
+    with contextlib.ExitStack() as stack:
+        if jobs > 1:
+            executor = stack.enter_context(
+                ProcessPoolExecutor(jobs, initializer=init_worker, initargs=(warnings.filters,))
             )
-            print(
-                ('The initial state:  ' + sha2.formatter * 8 + '  ' + sha2.formatter * 2).format(
-                    *iv
+            outcomes = executor.map(experiment, seeds)
+        else:
+            outcomes = map(experiment, seeds)
+        for experiment_outcomes in outcomes:
+            for index, (trace_count, (result_success, lsb_success, line)) in enumerate(
+                zip(sorted(trace_counts), experiment_outcomes)
+            ):
+                result_success_counts[index] += result_success
+                lsb_success_counts[index] += lsb_success
+                lsb_square_sums[index] += (lsb_success / (2 * sha2.bit_count)) ** 2
+                if line is not None:
+                    print('{:9d} {}'.format(trace_count, line))
+    if reports is not None:
+        z = statistics.NormalDist().inv_cdf((1 + confidence) / 2)
+        for result_success_count, lsb_success_count, lsb_square_sum in zip(
+            result_success_counts, lsb_success_counts, lsb_square_sums
+        ):
+            reports.append(
+                dict(
+                    experiment_count=experiment_count,
+                    m1_interval=wilson_interval(result_success_count, experiment_count, z),
+                    m2_interval=mean_interval(
+                        lsb_success_count / (2 * sha2.bit_count),
+                        lsb_square_sum,
+                        experiment_count,
+                        z,
+                    ),
                 )
             )
-        try:
-            # Perform the attack
-            if not verbose and not filter_hypo:
-                print('{:8d}'.format(seed + i), end=' ')
-            results, count = sha2_attack(
-                sha2,
-                data,
-                traces,
-                second_stage_count,
-                filter_hypotheses if filter_hypo else None,
-                verbose
+    return [
+        (
+            result_success_count / experiment_count * 100,
+            lsb_success_count / experiment_count / (2 * sha2.bit_count) * 100,
+        )
+        for result_success_count, lsb_success_count in zip(
+            result_success_counts, lsb_success_counts
+        )
+    ]
+
+
+def end_to_end_attack(
+    sha2,
+    trace_count,
+    second_stage_count,
+    noise,
+    experiment_count,
+    seed=None,
+    filter_hypo=True,
+    verbose=False,
+    chunk_size=None,
+    jobs=1,
+    stage2_jobs=1,
+    memory_limit=None,
+    screen_bits=0,
+    screen_count=None,
+    stream=False,
+    load_traces=None,
+    save_traces=None,
+    single=False,
+    profiler=None,
+    ci_width=None,
+    confidence=0.95,
+    lsb_ci=False,
+    report=None,
+    batch_size=None,
+    verify_count=0,
+    verify_rounds=8,
+):
+    """Perform experiment_count experiments with seeds seed, seed + 1, ...
+
+    If jobs > 1, the experiments are spread across jobs worker processes. The
+    lines reported for the experiments are printed in the order of the seeds,
+    and the result is the same as that of the sequential run. If
+    stage2_jobs > 1, stage 2 of every experiment is performed by stage2_jobs
+    worker processes. memory_limit bounds the memory used for a batch of
+    hypotheses at stage 2. If screen_bits > 0, the stage 1 hypotheses are
+    pre-screened on screen_bits bits and screen_count traces (if None, only
+    when they do not fit in a single batch, see sha2_attack.stage2). If
+    stream, the traces are generated in chunks on every pass instead of being
+    held in memory. load_traces and save_traces are trace set files to read
+    the traces from or to write them to (for a single experiment). If single,
+    noisy traces are generated as float32 rather than float64. If profiler is
+    set, the steps of all the experiments are recorded in it (only if
+    jobs == 1).
+    If verify_count is set, the candidates of every experiment are verified
+    on the later rounds (see attack_traces).
+
+    If ci_width is set, experiment_count is only the maximum number of
+    experiments. The experiments stop as soon as the confidence interval of
+    M1 (and of M2, if lsb_ci) at the given confidence level is at most
+    ci_width percents wide. The outcome does not depend on jobs. If report is
+    a dictionary, the number of performed experiments, the number of
+    successful experiments and the confidence intervals of M1, M2 are stored
+    in it as 'experiment_count', 'success_count', 'm1_interval' and
+    'm2_interval'.
+
+    If batch_size is set, the experiments are performed batch_size at a time
+    by run_experiment_batch, with the same outcome. verbose, chunk_size,
+    stage2_jobs, screen_bits, stream, load_traces, save_traces, profiler and
+    the verification are not used then.
+
+    Returns the estimations of metrics M1, M2 (in percents).
+    """
+
+    if seed is None:
+        seed = random.getrandbits(32)
+    seeds = range(seed, seed + experiment_count)
+    if batch_size:
+        experiment = functools.partial(
+            run_experiment_batch,
+            sha2,
+            trace_count,
+            second_stage_count,
+            noise,
+            filter_hypo=filter_hypo,
+            memory_limit=memory_limit,
+            single=single,
+        )
+        runs = [seeds[start:start + batch_size] for start in range(0, len(seeds), batch_size)]
+    else:
+        experiment = functools.partial(
+            run_experiment,
+            sha2,
+            trace_count,
+            second_stage_count,
+            noise,
+            filter_hypo=filter_hypo,
+            verbose=verbose,
+            chunk_size=chunk_size,
+            stage2_jobs=stage2_jobs,
+            memory_limit=memory_limit,
+            screen_bits=screen_bits,
+            screen_count=screen_count,
+            stream=stream,
+            load_traces=load_traces,
+            save_traces=save_traces,
+            single=single,
+            profiler=profiler,
+            verify_count=verify_count,
+            verify_rounds=verify_rounds,
+        )
+        runs = seeds
+    with contextlib.ExitStack() as stack:
+        if jobs > 1:
+            executor = stack.enter_context(
+                ProcessPoolExecutor(jobs, initializer=init_worker, initargs=(warnings.filters,))
             )
-            # Errors in stage 2 are exceptionally rare. If one happens, we count only
-            # one correct word although in fact it may be more
-            lsb_success_count += 2 * sha2.bit_count if iv[:8] in results else sha2.bit_count
-            result_success_count += 1
-            # Print the results
-            if verbose:
-                print('The remaining candidates:')
-            elif not filter_hypo:
-                print('Success {:5d} {:3d}'.format(count, len(results)))
-            for result in results:
-                if verbose:
-                    print(
-                        (' ' * 20 + sha2.formatter * 8 + '  {}').format(
-                            *result, 'correct' if result == iv[:8] else 'wrong'
-                        )
-                    )
-        except ValueError as error_index:
-            lsb_success_count += int('{}'.format(error_index))
-            if verbose or not filter_hypo:
-                print('Failure: bit {}'.format(error_index))
+            outcomes = executor.map(experiment, runs)
+            # If the experiments stop early, the pending ones are cancelled
+            stack.callback(executor.shutdown, cancel_futures=True)
+        else:
+            outcomes = map(experiment, runs)
+        if batch_size:
+            outcomes = itertools.chain.from_iterable(outcomes)
+        z = statistics.NormalDist().inv_cdf((1 + confidence) / 2)
+        count, result_success_count, lsb_success_count, lsb_square_sum = 0, 0, 0, 0
+        for result_success, lsb_success, line in outcomes:
+            count += 1
+            result_success_count += result_success
+            lsb_success_count += lsb_success
+            lsb_square_sum += (lsb_success / (2 * sha2.bit_count)) ** 2
+            if line is not None:
+                print(line)
+            if ci_width is not None:
+                m1_interval = wilson_interval(result_success_count, count, z)
+                m2_interval = mean_interval(
+                    lsb_success_count / (2 * sha2.bit_count), lsb_square_sum, count, z
+                )
+                if m1_interval[1] - m1_interval[0] <= ci_width and (
+                    not lsb_ci or m2_interval[1] - m2_interval[0] <= ci_width
+                ):
+                    break
+    if report is not None:
+        report['experiment_count'] = count
+        report['success_count'] = result_success_count
+        report['m1_interval'] = wilson_interval(result_success_count, count, z)
+        report['m2_interval'] = mean_interval(
+            lsb_success_count / (2 * sha2.bit_count), lsb_square_sum, count, z
+        )
     return (
-        result_success_count / experiment_count * 100,
-        lsb_success_count / experiment_count / (2 * sha2.bit_count) * 100,
+        result_success_count / count * 100,
+        lsb_success_count / count / (2 * sha2.bit_count) * 100,
     )
+
+
+def wilson_interval(success_count, count, z):
+    """Wilson score interval of a success probability (in percents) for
+    success_count successes in count experiments and the normal quantile z"""
+
+    if count == 0:
+        return 0.0, 100.0
+    p = success_count / count
+    scale = 1 + z * z / count
+    center = (p + z * z / (2 * count)) / scale
+    half_width = z * math.sqrt(p * (1 - p) / count + z * z / (4 * count * count)) / scale
+    return max(center - half_width, 0) * 100, min(center + half_width, 1) * 100
+
+
+def mean_interval(total, square_total, count, z):
+    """Normal approximation interval of the mean (in percents) of count values
+    in [0, 1] with the given sum and sum of squares, for the normal quantile
+    z"""
+
+    if count < 2:
+        return 0.0, 100.0
+    mean = total / count
+    variance = max(square_total - count * mean * mean, 0) / (count - 1)
+    half_width = z * math.sqrt(variance / count)
+    return max(mean - half_width, 0) * 100, min(mean + half_width, 1) * 100
@@ -0,0 +1,496 @@
+# Copyright © 2022-present FortifyIQ, Inc. All rights reserved. 
+#
+# This program, sha2-attack, is free software: you can redistribute it and/or modify
+# it under the terms and conditions of FortifyIQ’s free use license (”License”)
+# which is located at
+# https://raw.githubusercontent.com/fortify-iq/sha2-attack/master/LICENSE.
+# This license governs use of the accompanying software. If you use the
+# software, you accept this license. If you do not accept the license, do not
+# use the software.
+#
+# The License permits non-commercial use, but does not permit commercial use or
+# resale. This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY OR RIGHT TO ECONOMIC DAMAGES; without even the implied
+# warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+#
+# If you have any questions regarding the software of the license, please
+# contact kreimer@fortifyiq.com
+
+import argparse
+import contextlib
+import functools
+import hashlib
+import hmac
+import random
+import warnings
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from sha2 import Sha256, Sha512
+from sha2_attack import init_worker, sha2_attack
+from sha2_end_to_end import hypotheses_filter
+
+# The number of known tags that a pair of inner and outer candidates must
+# reproduce
+VERIFY_COUNT = 8
+
+# A two-word message (for either bit size) whose tag is forged with the
+# recovered states
+FORGED_MESSAGE = b'Forged HMAC tag!'
+
+HmacTraces = namedtuple(
+    'HmacTraces',
+    ('key', 'messages', 'tags', 'inner_traces', 'outer_traces', 'inner_iv', 'outer_iv'),
+)
+
+
+def hash_function(sha2):
+    """The hashlib constructor of sha2"""
+    return hashlib.sha256 if sha2.bit_count == 32 else hashlib.sha512
+
+
+def to_words(sha2, data):
+    """The big-endian words of the bytes data"""
+    return np.frombuffer(data, dtype='>u{}'.format(sha2.bit_count // 8)).astype(sha2.dtype)
+
+
+def to_bytes(sha2, words):
+    """The big-endian bytes of words"""
+    return np.asarray(words, dtype=sha2.dtype).astype('>u{}'.format(sha2.bit_count // 8)).tobytes()
+
+
+def hmac_states(sha2, key):
+    """The secret initial states of the inner and the outer hash of HMAC with
+    the given key, i.e., the states after the key block XORed with ipad and
+    with opad (each followed by DeltaA_0, DeltaE_0, as in generate_traces)"""
+
+    block_size = 2 * sha2.bit_count
+    if len(key) > block_size:
+        key = hash_function(sha2)(key).digest()
+    words = to_words(sha2, key.ljust(block_size, b'\0'))
+    return [list(sha2().compress(words ^ pad)) for pad in (sha2.ipad, sha2.opad)]
+
+
+def inner_blocks(sha2, messages):
+    """The padded second blocks (16 x N) of the inner hash of HMAC on the
+    two-word messages (N x 2)"""
+
+    blocks = np.zeros((16, len(messages)), dtype=sha2.dtype)
+    blocks[:2] = messages.T
+    blocks[2] = sha2.dtype(1) << sha2.dtype(sha2.bit_count - 1)
+    blocks[14:] = np.array(sha2.isize, dtype=sha2.dtype)[:, None]
+    return blocks
+
+
+def outer_blocks(sha2, digests):
+    """The padded second blocks (16 x N) of the outer hash of HMAC on the
+    inner digests (8 x N)"""
+
+    blocks = np.zeros((16, digests.shape[1]), dtype=sha2.dtype)
+    blocks[:8] = digests
+    blocks[8] = sha2.dtype(1) << sha2.dtype(sha2.bit_count - 1)
+    # The key block and the inner digest, in bits
+    blocks[15] = 24 * sha2.bit_count
+    return blocks
+
+
+def hmac_compress(sha2, inner_iv, outer_iv, messages, trace_size=2):
+    """HMAC on the two-word messages (N x 2) for the given inner and outer
+    initial states, as batched compressions of the second blocks.
+
+    Returns:
+    1) the inner digests (8 x N);
+    2) the tags (8 x N);
+    3) the traces of the first trace_size rounds of the inner compressions
+    (N x trace_size);
+    4) the same for the outer compressions.
+    """
+
+    sha = sha2()
+    digests, inner_traces = sha.compress(inner_blocks(sha2, messages), inner_iv[:8], trace_size)
+    tags, outer_traces = sha.compress(outer_blocks(sha2, digests), outer_iv[:8], trace_size)
+    return digests, tags, np.ascontiguousarray(inner_traces.T), np.ascontiguousarray(outer_traces.T)
+
+
+def generate_hmac_traces(sha2, trace_count, seed, noise, key_size=None, single=False):
+    """A random key of key_size bytes (the digest size by default), trace_count
+    random two-word messages, their tags and the traces of the inner and the
+    outer compressions, all from a single simulated HMAC computation per
+    message, and the secret inner and outer initial states.
+
+    As in generate_traces, noiseless traces are the smallest sufficient
+    unsigned integers, and noisy traces are float64, or float32 if single.
+    """
+
+    state = np.random.RandomState(seed)
+    key = state.bytes(key_size or sha2.bit_count)
+    messages = state.randint(1 << sha2.bit_count, size=(trace_count, 2), dtype=sha2.dtype)
+    inner_iv, outer_iv = hmac_states(sha2, key)
+    _, tags, *trace_sets = hmac_compress(sha2, inner_iv, outer_iv, messages)
+    for index, traces in enumerate(trace_sets):
+        if noise:
+            traces = traces.astype(np.float32 if single else float)
+            traces += state.normal(scale=noise, size=traces.shape)
+        elif traces.max(initial=0) <= 0xff:
+            traces = traces.astype(np.uint8)
+        trace_sets[index] = traces
+    return HmacTraces(key, messages, tags.T, *trace_sets, inner_iv, outer_iv)
+
+
+def outer_attack(
+    sha2,
+    messages,
+    tags,
+    outer_traces,
+    inner_candidates,
+    second_stage_count=None,
+    filter_hypo=None,
+    **options,
+):
+    """Attack on the outer hash for every one of inner_candidates.
+
+    The known inputs of the outer compression are the first two words of the
+    inner digests, so they are computed from every inner candidate. The
+    options are passed to sha2_attack.
+
+    Returns the pairs of inner and outer candidates that reproduce the first
+    VERIFY_COUNT tags (N x 8).
+    """
+
+    sha = sha2()
+    pairs = []
+    failure = None
+    for inner in inner_candidates:
+        digests, _ = sha.compress(inner_blocks(sha2, messages), inner, 0)
+        try:
+            outer_candidates, _ = sha2_attack(
+                sha2,
+                np.ascontiguousarray(digests[:2].T),
+                outer_traces,
+                second_stage_count,
+                filter_hypo,
+                **options,
+            )
+        except ValueError as error:
+            failure = error
+            continue
+        for outer in outer_candidates:
+            _, forged, _, _ = hmac_compress(sha2, inner, outer, messages[:VERIFY_COUNT], 0)
+            if np.array_equal(forged.T, tags[:VERIFY_COUNT]):
+                pairs.append((inner, outer))
+    if not pairs:
+        raise failure or ValueError('{}'.format(sha2.bit_count))
+    return pairs
+
+
+def hmac_attack(
+    sha2,
+    messages,
+    tags,
+    inner_traces,
+    outer_traces,
+    second_stage_count=None,
+    inner_filter=None,
+    outer_filter=None,
+    **options,
+):
+    """Recover the inner and outer initial states of HMAC from the known
+    two-word messages (N x 2), their tags (N x 8) and the traces of the inner
+    and the outer compressions.
+
+    The inner hash is attacked first, and then the outer hash for every inner
+    candidate (see outer_attack). inner_filter and outer_filter are the
+    filter_hypo functions of the two attacks, and the options are passed to
+    sha2_attack. The recovered states suffice to compute the tag of any
+    message without the key (see forge_tag).
+
+    Returns:
+    1) the pairs of inner and outer candidates that reproduce the tags;
+    2) the number of inner candidates.
+
+    If either attack fails, raises ValueError('inner bit <index>') or
+    ValueError('outer bit <index>').
+    """
+
+    try:
+        inner_candidates, _ = sha2_attack(
+            sha2, messages, inner_traces, second_stage_count, inner_filter, **options
+        )
+    except ValueError as error_index:
+        raise ValueError('inner bit {}'.format(error_index))
+    try:
+        pairs = outer_attack(
+            sha2,
+            messages,
+            tags,
+            outer_traces,
+            inner_candidates,
+            second_stage_count,
+            outer_filter,
+            **options,
+        )
+    except ValueError as error_index:
+        raise ValueError('outer bit {}'.format(error_index))
+    return pairs, len(inner_candidates)
+
+
+def forge_tag(sha2, inner, outer, message):
+    """The HMAC tag of the two-word message (bytes) for the inner and outer
+    initial states inner and outer"""
+
+    words = to_words(sha2, message).reshape(1, 2)
+    _, tags, _, _ = hmac_compress(sha2, inner, outer, words, 0)
+    return to_bytes(sha2, tags[:, 0])
+
+
+def run_hmac_experiment(
+    sha2,
+    trace_count,
+    second_stage_count,
+    noise,
+    seed,
+    filter_hypo=True,
+    key_size=None,
+    single=False,
+    **options,
+):
+    """Generate the HMAC traces with the given seed, recover the inner and
+    outer initial states, and verify a tag forged with them against hmac.
+
+    Returns:
+    1) 1 if the forged tag is correct, otherwise 0;
+    2) the line to report for the experiment.
+    """
+
+    generated = generate_hmac_traces(sha2, trace_count, seed, noise, key_size, single)
+    filters = (
+        [hypotheses_filter(sha2, iv) for iv in (generated.inner_iv, generated.outer_iv)]
+        if filter_hypo
+        else [None, None]
+    )
+    try:
+        pairs, inner_count = hmac_attack(
+            sha2,
+            generated.messages,
+            generated.tags,
+            generated.inner_traces,
+            generated.outer_traces,
+            second_stage_count,
+            *filters,
+            **options,
+        )
+    except ValueError as failure:
+        return 0, '{:8d} Failure: {}'.format(seed, failure)
+    message = FORGED_MESSAGE[:sha2.bit_count // 4]
+    expected = hmac.new(generated.key, message, hash_function(sha2)).digest()
+    forged = [forge_tag(sha2, inner, outer, message) for inner, outer in pairs]
+    # The forgery succeeds only if all the remaining pairs agree on the tag
+    success = set(forged) == {expected}
+    return int(success), '{:8d} Success {:3d} {:3d}  forged tag {}'.format(
+        seed, inner_count, len(pairs), 'verified' if success else 'rejected'
+    )
+
+
+def hmac_end_to_end_attack(
+    sha2,
+    trace_count,
+    second_stage_count,
+    noise,
+    experiment_count,
+    seed=None,
+    filter_hypo=True,
+    jobs=1,
+    **options,
+):
+    """Perform experiment_count HMAC experiments with seeds seed, seed + 1, ...
+    (see run_hmac_experiment), spread across jobs worker processes if
+    jobs > 1. The line of every experiment is printed in the order of the
+    seeds. The options are passed to run_hmac_experiment.
+
+    Returns the percentage of the experiments whose forged tag is correct.
+    """
+
+    if seed is None:
+        seed = random.getrandbits(32)
+    experiment = functools.partial(
+        run_hmac_experiment,
+        sha2,
+        trace_count,
+        second_stage_count,
+        noise,
+        filter_hypo=filter_hypo,
+        **options,
+    )
+    seeds = range(seed, seed + experiment_count)
+    success_count = 0
+    with contextlib.ExitStack() as stack:
+        if jobs > 1:
+            executor = stack.enter_context(
+                ProcessPoolExecutor(jobs, initializer=init_worker, initargs=(warnings.filters,))
+            )
+            outcomes = executor.map(experiment, seeds)
+        else:
+            outcomes = map(experiment, seeds)
+        for success, line in outcomes:
+            success_count += success
+            print(line, flush=True)
+    return success_count / experiment_count * 100
+
+
+def parse():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '-b',
+        '--bit-count',
+        type=int,
+        choices=[32, 64],
+        default=32,
+        help='Bit size of words - 32 for HMAC-SHA256 or 64 for HMAC-SHA512 (32 by default)',
+    )
+    parser.add_argument(
+        '-t',
+        '--trace-count',
+        type=int,
+        default=100000,
+        help='Number of HMAC computations to acquire the traces of (100K by default)',
+    )
+    parser.add_argument(
+        '-s',
+        '--second-stage-count',
+        type=int,
+        default=None,
+        help='Number of traces to use for the second stage (by default, the same number as used '
+        'for stage 1)',
+    )
+    parser.add_argument(
+        '-n',
+        '--noise',
+        type=float,
+        default=None,
+        help='Standard deviation of the normally distributed noise '
+        'added to the trace (0 by default)',
+    )
+    parser.add_argument(
+        '-k',
+        '--key-size',
+        type=int,
+        default=None,
+        help='Size of the random key in bytes (by default, the digest size)',
+    )
+    parser.add_argument(
+        '-e',
+        '--experiment-count',
+        type=int,
+        default=1,
+        help='Number of experiments to perform (1 by default)',
+    )
+    parser.add_argument(
+        '-r',
+        '--random-seed',
+        type=int,
+        default=None,
+        help='Random seed of the first experiment (by default, a random seed)',
+    )
+    parser.add_argument(
+        '-f',
+        '--filter-hypo',
+        action='store_true',
+        help='Perform the second stages only on the correct hypotheses',
+    )
+    parser.add_argument(
+        '-j',
+        '--jobs',
+        type=int,
+        default=1,
+        help='Number of worker processes performing the experiments (1 by default)',
+    )
+    parser.add_argument(
+        '-c',
+        '--chunk-size',
+        type=int,
+        default=None,
+        help='Number of traces processed at a time by the attack (by default, all traces at once)',
+    )
+    parser.add_argument(
+        '-m',
+        '--memory-limit',
+        type=int,
+        default=None,
+        help='Memory in MB used for a batch of hypotheses at stage 2 (256 MB by default)',
+    )
+    parser.add_argument(
+        '--screen-bits',
+        type=int,
+        default=None,
+        help='Number of bits of stage 2 on which the hypotheses are pre-screened, 0 - no '
+        'pre-screening (by default, 11 for SHA256 and 26 for SHA512 if the hypotheses do not '
+        'fit in a single batch of stage 2)',
+    )
+    parser.add_argument(
+        '--screen-count',
+        type=int,
+        default=16384,
+        help='Number of traces used for the pre-screening (16K by default)',
+    )
+    parser.add_argument(
+        '--float32',
+        action='store_true',
+        help='Generate noisy traces as 32-bit rather than 64-bit floating point numbers',
+    )
+    args = parser.parse_args()
+    return (
+        Sha256 if args.bit_count == 32 else Sha512,
+        args.trace_count,
+        args.second_stage_count,
+        args.noise,
+        args.key_size,
+        args.experiment_count,
+        args.random_seed,
+        args.filter_hypo,
+        args.jobs,
+        args.chunk_size,
+        args.memory_limit << 20 if args.memory_limit else None,
+        args.screen_bits,
+        args.screen_count,
+        args.float32,
+    )
+
+
+if __name__ == '__main__':
+    (
+        sha2,
+        trace_count,
+        second_stage_count,
+        noise,
+        key_size,
+        experiment_count,
+        seed,
+        filter_hypo,
+        jobs,
+        chunk_size,
+        memory_limit,
+        screen_bits,
+        screen_count,
+        single,
+    ) = parse()
+    # Suppress expected overflows in addition and subtraction
+    warnings.filterwarnings('ignore', category=RuntimeWarning)
+    success_ratio = hmac_end_to_end_attack(
+        sha2,
+        trace_count,
+        second_stage_count,
+        noise,
+        experiment_count,
+        seed,
+        filter_hypo,
+        jobs,
+        key_size=key_size,
+        single=single,
+        chunk_size=chunk_size,
+        memory_limit=memory_limit,
+        screen_bits=screen_bits,
+        screen_count=screen_count,
+    )
+    print('{:5.2f}% forged tags verified'.format(success_ratio))
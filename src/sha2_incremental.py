@@ -0,0 +1,226 @@
+# Copyright © 2022-present FortifyIQ, Inc. All rights reserved. 
+#
+# This program, sha2-attack, is free software: you can redistribute it and/or modify
+# it under the terms and conditions of FortifyIQ’s free use license (”License”)
+# which is located at
+# https://raw.githubusercontent.com/fortify-iq/sha2-attack/master/LICENSE.
+# This license governs use of the accompanying software. If you use the
+# software, you accept this license. If you do not accept the license, do not
+# use the software.
+#
+# The License permits non-commercial use, but does not permit commercial use or
+# resale. This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY OR RIGHT TO ECONOMIC DAMAGES; without even the implied
+# warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+#
+# If you have any questions regarding the software of the license, please
+# contact kreimer@fortifyiq.com
+
+import argparse
+import warnings
+
+import numpy as np
+
+from sha2 import Sha256, Sha512
+from sha2_attack import stage1, stage2
+from sha2_trace_generation import generate_traces
+from sha2_trace_set import PrefixStatistics, TraceSet
+
+
+class IncrementalAttack:
+    """Attack on traces that arrive in batches (e.g., from a capture rig).
+
+    After every batch passed to add_traces, both stages are performed anew on
+    all the traces received so far. The partition statistics are kept across
+    the batches (see PrefixStatistics), so that a decision whose partition
+    did not change since the previous batch is updated with the new traces
+    only. Only the decisions of new hypotheses are computed from scratch.
+
+    The outcome after a batch is the same as that of sha2_attack on all the
+    traces received so far. The candidates are stable when they have not
+    changed for stable_count batches in a row, at which point the capture
+    can be stopped.
+    """
+
+    def __init__(
+        self,
+        sha2,
+        second_stage_count=None,
+        chunk_size=None,
+        memory_limit=None,
+        stable_count=3,
+    ):
+        """second_stage_count, if set, bounds the number of traces used at
+        stage 2 (by default, all the traces are used)"""
+
+        self.sha2 = sha2
+        self.second_stage_count = second_stage_count
+        self.chunk_size = chunk_size
+        self.memory_limit = memory_limit
+        self.stable_count = stable_count
+        # The traces received so far are the first trace_count rows of the
+        # buffers, whose capacity is doubled as needed
+        self.trace_count = 0
+        self.data = None
+        self.traces = None
+        self.statistics = None
+        self.stage1_hypos = []
+        self.candidates = []
+        # Bit index of the failure of stage 1, or None if stage 1 succeeded
+        self.failure = None
+        self.unchanged_count = 0
+
+    @property
+    def stable(self):
+        """Whether the candidates did not change for stable_count batches"""
+        return len(self.candidates) > 0 and self.unchanged_count >= self.stable_count
+
+    def add_traces(self, data, traces):
+        """Append a batch of inputs (N x 2 words) and traces (N x 2 samples),
+        and update the attack. Returns the current candidates for the secret
+        initial state."""
+
+        count = self.trace_count + len(data)
+        if self.data is None or count > len(self.data):
+            capacity = max(count, 2 * self.trace_count)
+            self.data = self.resize(self.data, capacity, data)
+            self.traces = self.resize(self.traces, capacity, traces)
+        self.data[self.trace_count:count] = data
+        self.traces[self.trace_count:count] = traces
+        self.trace_count = count
+        trace_set = TraceSet(self.data[:count], self.traces[:count], self.chunk_size)
+        if self.statistics is None:
+            self.statistics = PrefixStatistics(trace_set)
+        else:
+            # The statistics of the earlier traces remain valid
+            self.statistics.trace_set = trace_set
+        self.update()
+        return self.candidates
+
+    def resize(self, buffer, capacity, batch):
+        resized = np.empty((capacity,) + batch.shape[1:], dtype=batch.dtype)
+        if buffer is not None:
+            resized[:self.trace_count] = buffer[:self.trace_count]
+        return resized
+
+    def update(self):
+        """Perform both stages on the traces received so far"""
+
+        trace_set = self.statistics.prefix(self.trace_count)
+        candidates = []
+        try:
+            self.stage1_hypos = stage1(self.sha2, trace_set, None, False)
+            self.failure = None
+        except ValueError as error:
+            self.stage1_hypos = []
+            self.failure = int('{}'.format(error))
+        if self.stage1_hypos:
+            candidates = stage2(
+                self.sha2,
+                trace_set.head(self.second_stage_count or self.trace_count),
+                None,
+                self.stage1_hypos,
+                False,
+                memory_limit=self.memory_limit,
+            )
+        if candidates and candidates == self.candidates:
+            self.unchanged_count += 1
+        else:
+            self.unchanged_count = 0
+        self.candidates = candidates
+        # The statistics of the rejected hypotheses are not needed anymore
+        self.statistics.discard_unused()
+
+
+def parse():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '-b',
+        '--bit-count',
+        type=int,
+        choices=[32, 64],
+        default=32,
+        help='Bit size of words - 32 for SHA256 or 64 for SHA512 (32 by default)',
+    )
+    parser.add_argument(
+        '-t',
+        '--trace-count',
+        type=int,
+        default=1 << 20,
+        help='Maximum number of traces to capture (2^20 by default)',
+    )
+    parser.add_argument(
+        '--batch-size',
+        type=int,
+        default=1 << 14,
+        help='Number of traces per captured batch (2^14 by default)',
+    )
+    parser.add_argument(
+        '-n',
+        '--noise',
+        type=float,
+        default=None,
+        help='Standard deviation of the normally distributed noise '
+        'added to the trace (0 by default)',
+    )
+    parser.add_argument(
+        '--stable-count',
+        type=int,
+        default=3,
+        help='Number of batches without a change of the candidates after which the capture '
+        'stops (3 by default)',
+    )
+    parser.add_argument(
+        '-r',
+        '--random-seed',
+        type=int,
+        default=0,
+        help='Random seed of the simulated capture (0 by default)',
+    )
+    parser.add_argument(
+        '-c',
+        '--chunk-size',
+        type=int,
+        default=None,
+        help='Number of traces processed at a time by the attack (by default, all traces at once)',
+    )
+    args = parser.parse_args()
+    return (
+        Sha256 if args.bit_count == 32 else Sha512,
+        args.trace_count,
+        args.batch_size,
+        args.noise,
+        args.stable_count,
+        args.random_seed,
+        args.chunk_size,
+    )
+
+
+if __name__ == '__main__':
+    sha2, trace_count, batch_size, noise, stable_count, seed, chunk_size = parse()
+    # Suppress expected overflows in addition and subtraction
+    warnings.filterwarnings('ignore', category=RuntimeWarning)
+    # The capture is simulated by the batches of a single trace set
+    data, traces, iv = generate_traces(sha2, trace_count, seed, noise)
+    attack = IncrementalAttack(sha2, chunk_size=chunk_size, stable_count=stable_count)
+    for start in range(0, trace_count, batch_size):
+        attack.add_traces(data[start:start + batch_size], traces[start:start + batch_size])
+        print(
+            '{:9d} traces: {:6d} stage 1 hypotheses, {:4d} candidates{}{}'.format(
+                attack.trace_count,
+                len(attack.stage1_hypos),
+                len(attack.candidates),
+                '' if attack.failure is None else ' (stage 1 failed at bit {})'.format(
+                    attack.failure
+                ),
+                ' - correct' if iv[:8] in attack.candidates else '',
+            ),
+            flush=True,
+        )
+        if attack.stable:
+            break
+    print(
+        'The candidates are {}stable after {} traces'.format(
+            '' if attack.stable else 'not ', attack.trace_count
+        )
+    )
@@ -0,0 +1,145 @@
+# Copyright © 2022-present FortifyIQ, Inc. All rights reserved. 
+#
+# This program, sha2-attack, is free software: you can redistribute it and/or modify
+# it under the terms and conditions of FortifyIQ’s free use license (”License”)
+# which is located at
+# https://raw.githubusercontent.com/fortify-iq/sha2-attack/master/LICENSE.
+# This license governs use of the accompanying software. If you use the
+# software, you accept this license. If you do not accept the license, do not
+# use the software.
+#
+# The License permits non-commercial use, but does not permit commercial use or
+# resale. This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY OR RIGHT TO ECONOMIC DAMAGES; without even the implied
+# warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+#
+# If you have any questions regarding the software of the license, please
+# contact kreimer@fortifyiq.com
+
+import contextlib
+import time
+import tracemalloc
+
+
+# The stages of the attack in the order in which they are performed
+STAGES = ('1a', '1b', '1c', '2-screen', '2')
+
+
+def stage_order(stage):
+    """Sort key of a stage, placing unknown stages last"""
+    return (STAGES.index(stage), '') if stage in STAGES else (len(STAGES), stage)
+
+
+class Profiler:
+    """Collects the wall time and the work of every step of an attack.
+
+    A step is a bit decided at a stage of the attack. Its record has the
+    stage ('1a', '1b', '1c', '2-screen' or '2'), the bit index, the wall time
+    in seconds, the number of passes over the trace set, the total number of
+    trace classes averaged, and the number of stage 1 options or stage 2
+    hypotheses at the start of the step. If tracemalloc is tracing, the
+    record also has the peak memory allocated during the step, in bytes.
+    Steps do not nest.
+    """
+
+    def __init__(self):
+        self.records = []
+        self.current = None
+
+    @contextlib.contextmanager
+    def step(self, stage, bit_index=None, **counts):
+        self.open(stage, bit_index, counts)
+        try:
+            yield
+        finally:
+            self.close()
+
+    def switch(self, stage, **counts):
+        """Close the current step and open a step of another stage for the same
+        bit (e.g., substage 1b at the bit of the first mismatch)"""
+        if self.current is not None:
+            bit_index = self.current['bit']
+            self.close()
+            self.open(stage, bit_index, counts)
+
+    def open(self, stage, bit_index, counts):
+        self.current = dict(stage=stage, bit=bit_index, passes=0, classes=0, **counts)
+        self.tracing = tracemalloc.is_tracing()
+        if self.tracing:
+            tracemalloc.reset_peak()
+            self.base = tracemalloc.get_traced_memory()[0]
+        self.start = time.perf_counter()
+
+    def close(self):
+        record = self.current
+        record['seconds'] = time.perf_counter() - self.start
+        if self.tracing:
+            record['peak_bytes'] = tracemalloc.get_traced_memory()[1] - self.base
+        self.current = None
+        self.records.append(record)
+
+    def count_classes(self, class_count):
+        """Count a pass over the trace set that averages class_count classes"""
+        if self.current is not None:
+            self.current['passes'] += 1
+            self.current['classes'] += class_count
+
+    def summary(self):
+        """Totals per stage, in the order of the stages (see stage_order)"""
+        stages = {}
+        for record in self.records:
+            total = stages.setdefault(
+                record['stage'],
+                dict(stage=record['stage'], steps=0, seconds=0, passes=0, classes=0),
+            )
+            total['steps'] += 1
+            for field in 'seconds', 'passes', 'classes':
+                total[field] += record[field]
+            if 'peak_bytes' in record:
+                total['peak_bytes'] = max(total.get('peak_bytes', 0), record['peak_bytes'])
+        return sorted(stages.values(), key=lambda total: stage_order(total['stage']))
+
+    def format_table(self):
+        """The records and the totals per stage as lines of text"""
+
+        def line(stage, bit, record):
+            return '{:8s} {:>5s} {:10.4f} {:7d} {:9d} {:>11s} {:>9s}'.format(
+                stage,
+                bit,
+                record['seconds'],
+                record['passes'],
+                record['classes'],
+                str(record.get('hypotheses', record.get('options', ''))),
+                '{:.1f}'.format(record['peak_bytes'] / (1 << 20))
+                if 'peak_bytes' in record else '',
+            )
+
+        def header(second):
+            return '{:8s} {:>5s} {:>10s} {:>7s} {:>9s} {:>11s} {:>9s}'.format(
+                'Stage', second, 'Seconds', 'Passes', 'Classes', 'Hypotheses', 'Peak MB'
+            )
+
+        lines = [header('Bit')]
+        lines += [
+            line(record['stage'], '' if record['bit'] is None else str(record['bit']), record)
+            for record in self.records
+        ]
+        lines += ['', header('Steps')]
+        lines += [line(total['stage'], str(total['steps']), total) for total in self.summary()]
+        return lines
+
+
+class NullProfiler:
+    """Profiler that collects nothing"""
+
+    def step(self, stage, bit_index=None, **counts):
+        return contextlib.nullcontext()
+
+    def switch(self, stage, **counts):
+        pass
+
+    def count_classes(self, class_count):
+        pass
+
+
+NO_PROFILER = NullProfiler()
@@ -0,0 +1,403 @@
+# Copyright © 2022-present FortifyIQ, Inc. All rights reserved. 
+#
+# This program, sha2-attack, is free software: you can redistribute it and/or modify
+# it under the terms and conditions of FortifyIQ’s free use license (”License”)
+# which is located at
+# https://raw.githubusercontent.com/fortify-iq/sha2-attack/master/LICENSE.
+# This license governs use of the accompanying software. If you use the
+# software, you accept this license. If you do not accept the license, do not
+# use the software.
+#
+# The License permits non-commercial use, but does not permit commercial use or
+# resale. This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY OR RIGHT TO ECONOMIC DAMAGES; without even the implied
+# warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+#
+# If you have any questions regarding the software of the license, please
+# contact kreimer@fortifyiq.com
+
+import argparse
+import csv
+import json
+import os
+import time
+import warnings
+from concurrent.futures import as_completed, ProcessPoolExecutor
+
+from sha2 import Sha256, Sha512
+from sha2_attack import init_worker
+from sha2_end_to_end import end_to_end_attack, nested_end_to_end_attack
+
+SHAS = {32: Sha256, 64: Sha512}
+SHEETS = (('res(M1).csv', 'm1'), ('lsb(M2).csv', 'm2'))
+
+
+def read_sheet(path):
+    """Values of a sheet in the layout of docs/res(M1).csv, as a dictionary
+    {(bit_count, noise, trace_count): value} of the non-empty cells"""
+
+    with open(path, newline='', encoding='utf-8-sig') as file:
+        rows = list(csv.reader(file))
+    trace_counts = [int(count) for count in rows[1][2:]]
+    values = {}
+    for row in rows[2:]:
+        if row[0]:
+            bit_count = int(row[0].split()[0])
+        noise = float(row[1])
+        for trace_count, value in zip(trace_counts, row[2:]):
+            if value:
+                values[bit_count, noise, trace_count] = float(value)
+    return values
+
+
+def write_sheet(path, values):
+    """Write the values {(bit_count, noise, trace_count): value} as a sheet
+    in the layout of docs/res(M1).csv"""
+
+    trace_counts = sorted({trace_count for _, _, trace_count in values})
+    rows = [
+        ['', '', '# of traces'] + [''] * (len(trace_counts) - 1),
+        ['# of bits', 'noise'] + trace_counts,
+    ]
+    for bit_count in sorted({bit_count for bit_count, _, _ in values}):
+        noises = sorted({noise for bits, noise, _ in values if bits == bit_count})
+        for index, noise in enumerate(noises):
+            label = '' if index else '{}\n({})'.format(bit_count, SHAS[bit_count].__name__.upper())
+            rows.append(
+                [label, '{:.2f}'.format(noise)]
+                + [
+                    '{:.2f}'.format(values[key]) if key in values else ''
+                    for key in ((bit_count, noise, trace_count) for trace_count in trace_counts)
+                ]
+            )
+    with open(path, 'w', newline='', encoding='utf-8-sig') as file:
+        csv.writer(file, lineterminator='\n').writerows(rows)
+
+
+def load_store(path):
+    """Records of the finished cells in a results store, as a dictionary
+    {key(record): record}. A store is a file with one JSON record per line. A
+    line cut short by an interruption is ignored."""
+
+    records = {}
+    if os.path.exists(path):
+        with open(path) as file:
+            for line in file:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                records[key(record)] = record
+    return records
+
+
+def key(record):
+    """The cell (bit_count, noise, trace_count, experiment_count) of a record
+    followed by the settings that affect its result (see settings)"""
+    return (
+        record['bit_count'],
+        record['noise'],
+        record['trace_count'],
+        record['experiment_count'],
+        record['seed'],
+        record.get('ci_width'),
+        record.get('confidence'),
+        record.get('nested', False),
+    )
+
+
+def settings(seed, nested, options):
+    """The settings of a sweep that affect the results of its cells, in the
+    order of key. A store may hold records of sweeps with other settings,
+    which are not reused."""
+    return seed, options.get('ci_width'), options.get('confidence'), nested
+
+
+def cost(cell):
+    """Relative run time of a cell (bit_count, noise, trace_count,
+    experiment_count)"""
+    bit_count, _, trace_count, experiment_count = cell
+    return bit_count * trace_count * experiment_count
+
+
+def run_cell(bit_count, noise, trace_count, experiment_count, seed=None, **options):
+    """Estimate M1, M2 for a cell of the sheets. The options are passed to
+    end_to_end_attack. Returns the record of the cell."""
+
+    start = time.perf_counter()
+    report = {}
+    m1, m2 = end_to_end_attack(
+        SHAS[bit_count],
+        trace_count,
+        trace_count,
+        noise,
+        experiment_count,
+        seed,
+        filter_hypo=True,
+        report=report,
+        **options,
+    )
+    return dict(
+        bit_count=bit_count,
+        noise=noise,
+        trace_count=trace_count,
+        experiment_count=experiment_count,
+        seed=seed,
+        ci_width=options.get('ci_width'),
+        confidence=options.get('confidence'),
+        m1=m1,
+        m2=m2,
+        performed_count=report['experiment_count'],
+        m1_interval=report['m1_interval'],
+        m2_interval=report['m2_interval'],
+        seconds=time.perf_counter() - start,
+    )
+
+
+def run_row(bit_count, noise, trace_counts, experiment_count, seed=None, **options):
+    """Estimate M1, M2 for the cells of a row of the sheets at once, on the
+    nested prefixes of one trace set per experiment. The options are passed
+    to nested_end_to_end_attack. Returns the records of the cells."""
+
+    start = time.perf_counter()
+    reports = []
+    metrics = nested_end_to_end_attack(
+        SHAS[bit_count],
+        trace_counts,
+        noise,
+        experiment_count,
+        seed,
+        filter_hypo=True,
+        reports=reports,
+        **options,
+    )
+    # The time of the row is shared by its cells in proportion to their costs
+    seconds = (time.perf_counter() - start) / sum(trace_counts)
+    return [
+        dict(
+            bit_count=bit_count,
+            noise=noise,
+            trace_count=trace_count,
+            experiment_count=experiment_count,
+            seed=seed,
+            nested=True,
+            m1=m1,
+            m2=m2,
+            performed_count=report['experiment_count'],
+            m1_interval=report['m1_interval'],
+            m2_interval=report['m2_interval'],
+            seconds=seconds * trace_count,
+        )
+        for trace_count, (m1, m2), report in zip(sorted(trace_counts), metrics, reports)
+    ]
+
+
+def sweep(cells, store, jobs=1, seed=None, progress=None, nested=False, **options):
+    """Run every cell (bit_count, noise, trace_count, experiment_count) that
+    is not yet in the store, the longest first, in jobs worker processes.
+
+    Every finished cell is appended to the store at once, so that an
+    interrupted sweep resumes where it stopped. Only the records of the store
+    with the same seed, ci_width, confidence and nested are reused (see key).
+    progress, if set, is called
+    with the record of every finished cell. If nested, the pending cells of a
+    row (bit_count, noise, experiment_count) are run as one task on nested
+    prefixes of the same trace sets (see run_row). Returns the records of all
+    the cells.
+    """
+
+    records = load_store(store)
+    sweep_settings = settings(seed, nested, options)
+    pending = sorted(
+        (cell for cell in cells if cell + sweep_settings not in records), key=cost, reverse=True
+    )
+    with ProcessPoolExecutor(
+        jobs, initializer=init_worker, initargs=(warnings.filters,)
+    ) as executor, open(store, 'a') as file:
+        if nested:
+            rows = {}
+            for bit_count, noise, trace_count, experiment_count in pending:
+                rows.setdefault((bit_count, noise, experiment_count), []).append(trace_count)
+            futures = [
+                executor.submit(
+                    run_row, bit_count, noise, trace_counts, experiment_count, seed, **options
+                )
+                for (bit_count, noise, experiment_count), trace_counts in rows.items()
+            ]
+        else:
+            futures = [executor.submit(run_cell, *cell, seed, **options) for cell in pending]
+        for future in as_completed(futures):
+            result = future.result()
+            for record in result if nested else [result]:
+                file.write(json.dumps(record) + '\n')
+                file.flush()
+                os.fsync(file.fileno())
+                records[key(record)] = record
+                if progress:
+                    progress(record)
+    return [records[cell + sweep_settings] for cell in cells]
+
+
+def write_sheets(directory, records):
+    """Write M1 and M2 of the records as res(M1).csv and lsb(M2).csv in the
+    layout of docs"""
+    for name, field in SHEETS:
+        write_sheet(
+            os.path.join(directory, name),
+            {
+                (record['bit_count'], record['noise'], record['trace_count']): record[field]
+                for record in records
+            },
+        )
+
+
+def parse():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '-b',
+        '--bit-count',
+        type=int,
+        nargs='+',
+        choices=[32, 64],
+        default=[32, 64],
+        help='Bit sizes of words - 32 for SHA256, 64 for SHA512 (both by default)',
+    )
+    parser.add_argument(
+        '-n',
+        '--noise',
+        type=float,
+        nargs='+',
+        default=[0.0],
+        help='Standard deviations of the noise (0 by default)',
+    )
+    parser.add_argument(
+        '-t',
+        '--trace-count-log',
+        type=int,
+        nargs='+',
+        default=list(range(12, 21)),
+        help='Binary logarithms of the numbers of traces (12 to 20 by default)',
+    )
+    parser.add_argument(
+        '-g',
+        '--grid',
+        default=None,
+        metavar='CSV',
+        help='Sheet in the layout of docs/res(M1).csv whose non-empty cells are the grid '
+        '(instead of "-b", "-n" and "-t")',
+    )
+    parser.add_argument(
+        '-e',
+        '--experiment-count',
+        type=int,
+        default=100,
+        help='Number of experiments per cell (100 by default)',
+    )
+    parser.add_argument(
+        '-w',
+        '--ci-width',
+        type=float,
+        default=None,
+        help='Stop the experiments of a cell as soon as the 95%% confidence interval of M1 '
+        'is at most this many percents wide (None by default)',
+    )
+    parser.add_argument(
+        '-r',
+        '--random-seed',
+        type=int,
+        default=None,
+        help='Random seed of the first experiment of every cell (None by default)',
+    )
+    parser.add_argument(
+        '-j',
+        '--jobs',
+        type=int,
+        default=os.cpu_count(),
+        help='Number of worker processes (the number of CPUs by default)',
+    )
+    parser.add_argument(
+        '-c',
+        '--chunk-size',
+        type=int,
+        default=None,
+        help='Number of traces processed at a time by the attack (by default, all traces at once)',
+    )
+    parser.add_argument(
+        '--batch-size',
+        type=int,
+        default=None,
+        help='Attack the traces of this many experiments of a cell at once (None by default)',
+    )
+    parser.add_argument(
+        '--nested',
+        action='store_true',
+        help='Run the cells of a row on nested prefixes of the same trace sets, reusing the '
+        'statistics of the shorter prefixes (cannot be used with "-w")',
+    )
+    parser.add_argument(
+        '-s',
+        '--store',
+        default='sweep.jsonl',
+        help='Results store, which is resumed if it exists ("sweep.jsonl" by default)',
+    )
+    parser.add_argument(
+        '-o',
+        '--output',
+        default=None,
+        metavar='DIR',
+        help='Directory to write res(M1).csv and lsb(M2).csv to',
+    )
+    args = parser.parse_args()
+    if args.nested and args.ci_width is not None:
+        parser.error('"--nested" cannot be used with "-w"')
+    if args.batch_size and (args.nested or args.chunk_size):
+        parser.error('"--batch-size" cannot be used with "--nested" or "-c"')
+    if args.grid:
+        grid = sorted(read_sheet(args.grid))
+    else:
+        grid = [
+            (bit_count, noise, 1 << log)
+            for bit_count in args.bit_count
+            for noise in args.noise
+            for log in args.trace_count_log
+        ]
+    return (
+        [grid_cell + (args.experiment_count,) for grid_cell in grid],
+        args.store,
+        args.jobs,
+        args.random_seed,
+        args.chunk_size,
+        args.ci_width,
+        args.batch_size,
+        args.nested,
+        args.output,
+    )
+
+
+if __name__ == '__main__':
+    cells, store, jobs, seed, chunk_size, ci_width, batch_size, nested, output = parse()
+    # Suppress expected overflows in addition and subtraction
+    warnings.filterwarnings('ignore', category=RuntimeWarning)
+    records = sweep(
+        cells,
+        store,
+        jobs,
+        seed,
+        lambda record: print(
+            '{:3d} {:6.2f} {:8d} {:6.2f}% {:6.2f}% {:6d} {:9.1f} s'.format(
+                record['bit_count'],
+                record['noise'],
+                record['trace_count'],
+                record['m1'],
+                record['m2'],
+                record['performed_count'],
+                record['seconds'],
+            ),
+            flush=True,
+        ),
+        nested=nested,
+        chunk_size=chunk_size,
+        **({} if nested else dict(ci_width=ci_width, batch_size=batch_size)),
+    )
+    if output:
+        write_sheets(output, records)
@@ -0,0 +1,74 @@
+# Copyright © 2022-present FortifyIQ, Inc. All rights reserved. 
+#
+# This program, sha2-attack, is free software: you can redistribute it and/or modify
+# it under the terms and conditions of FortifyIQ’s free use license (”License”)
+# which is located at
+# https://raw.githubusercontent.com/fortify-iq/sha2-attack/master/LICENSE.
+# This license governs use of the accompanying software. If you use the
+# software, you accept this license. If you do not accept the license, do not
+# use the software.
+#
+# The License permits non-commercial use, but does not permit commercial use or
+# resale. This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY OR RIGHT TO ECONOMIC DAMAGES; without even the implied
+# warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+#
+# If you have any questions regarding the software of the license, please
+# contact kreimer@fortifyiq.com
+
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+# Number of traces in a block of a kernel. The blocks do not depend on the
+# number of threads, and the results of the blocks are combined in the order
+# of the blocks, so that the results do not depend on the number of threads
+BLOCK_SIZE = 1 << 16
+
+thread_count = 1
+# The executor of the current process, created on first use (a worker
+# process started by fork does not inherit the threads of its parent)
+executor, executor_pid = None, None
+# Set in the threads of the executor, which run nested kernels inline
+local = threading.local()
+
+
+def set_threads(count):
+    """Set the number of threads running the blocks of the kernels (1 by
+    default, i.e., in the calling thread)"""
+
+    global thread_count, executor, executor_pid
+    if executor is not None and executor_pid == os.getpid():
+        executor.shutdown()
+    thread_count, executor, executor_pid = max(count, 1), None, None
+
+
+def mark_worker():
+    local.worker = True
+
+
+def map_blocks(function, length, block_size=BLOCK_SIZE):
+    """function(block) for the slices of range(length) in blocks of block_size,
+    in the order of the blocks. The blocks are spread across the threads (see
+    set_threads)."""
+
+    global executor, executor_pid
+    blocks = [slice(start, start + block_size) for start in range(0, length, block_size)]
+    if thread_count == 1 or len(blocks) < 2 or getattr(local, 'worker', False):
+        return [function(block) for block in blocks]
+    if executor is None or executor_pid != os.getpid():
+        executor = ThreadPoolExecutor(thread_count, initializer=mark_worker)
+        executor_pid = os.getpid()
+    return list(executor.map(function, blocks))
+
+
+def sum_blocks(function, length, block_size=BLOCK_SIZE):
+    """The sum of the tuples function(block) over the blocks (see map_blocks),
+    added up in the order of the blocks"""
+
+    totals = None
+    for result in map_blocks(function, length, block_size):
+        totals = result if totals is None else tuple(
+            total + value for total, value in zip(totals, result)
+        )
+    return totals
@@ -0,0 +1,280 @@
+# Copyright © 2022-present FortifyIQ, Inc. All rights reserved. 
+#
+# This program, sha2-attack, is free software: you can redistribute it and/or modify
+# it under the terms and conditions of FortifyIQ’s free use license (”License”)
+# which is located at
+# https://raw.githubusercontent.com/fortify-iq/sha2-attack/master/LICENSE.
+# This license governs use of the accompanying software. If you use the
+# software, you accept this license. If you do not accept the license, do not
+# use the software.
+#
+# The License permits non-commercial use, but does not permit commercial use or
+# resale. This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY OR RIGHT TO ECONOMIC DAMAGES; without even the implied
+# warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+#
+# If you have any questions regarding the software of the license, please
+# contact kreimer@fortifyiq.com
+
+import argparse
+import statistics
+import warnings
+
+from sha2 import Sha256, Sha512
+from sha2_end_to_end import end_to_end_attack, wilson_interval
+
+
+def probe(
+    sha2,
+    trace_count,
+    noise,
+    experiment_count,
+    seed,
+    target=50,
+    batch_size=10,
+    confidence=0.95,
+    **options,
+):
+    """Estimate whether M1 at trace_count traces is above target (in
+    percents).
+
+    The experiments are performed in batches of batch_size with seeds seed,
+    seed + 1, ..., until the confidence interval of M1 excludes target or
+    experiment_count experiments are performed. The options are passed to
+    end_to_end_attack.
+
+    Returns:
+    1) True if M1 is estimated to be above target;
+    2) the estimation of M1;
+    3) the confidence interval of M1;
+    4) the number of performed experiments.
+    """
+
+    z = statistics.NormalDist().inv_cdf((1 + confidence) / 2)
+    success_count, count = 0, 0
+    while count < experiment_count:
+        batch = min(batch_size, experiment_count - count)
+        report = {}
+        end_to_end_attack(
+            sha2,
+            trace_count,
+            trace_count,
+            noise,
+            batch,
+            seed + count,
+            filter_hypo=True,
+            report=report,
+            **options,
+        )
+        success_count += report['success_count']
+        count += batch
+        interval = wilson_interval(success_count, count, z)
+        if not interval[0] <= target <= interval[1]:
+            break
+    m1 = success_count / count * 100
+    return m1 > target, m1, interval, count
+
+
+def find_threshold(
+    sha2,
+    noise,
+    low=12,
+    high=24,
+    resolution=0.125,
+    experiment_count=200,
+    seed=0,
+    target=50,
+    progress=None,
+    **options,
+):
+    """Find the number of traces at which M1 crosses target (in percents) by
+    bisection over the binary logarithm of the number of traces.
+
+    M1 is assumed to be below target at 2^low traces and above it at 2^high
+    traces. Every probe (see probe) uses the same seeds, so that the probes
+    differ only in the number of traces. The bisection stops when the interval
+    is at most resolution wide. progress, if set, is called with the number
+    of traces and the outcome of every probe. The options are passed to
+    probe.
+
+    Returns:
+    1) the smallest number of traces at which M1 was estimated to be above
+    target, or None if it was below target at every probe (the assumption
+    about 2^high does not hold);
+    2) whether M1 was estimated to be below target at some probe (otherwise,
+    the assumption about 2^low is not confirmed, and the threshold may be at
+    or below 2^low traces);
+    3) the total number of performed experiments.
+    """
+
+    total_count = 0
+    above_count, below = None, False
+    while high - low > resolution:
+        middle = (low + high) / 2
+        trace_count = round(2 ** middle)
+        outcome = probe(sha2, trace_count, noise, experiment_count, seed, target, **options)
+        total_count += outcome[3]
+        if progress:
+            progress(trace_count, *outcome)
+        if outcome[0]:
+            high, above_count = middle, trace_count
+        else:
+            low, below = middle, True
+    return above_count, below, total_count
+
+
+def parse():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '-b',
+        '--bit-count',
+        type=int,
+        choices=[32, 64],
+        default=32,
+        help='Bit size of words - 32 for SHA256 or 64 for SHA512 (32 by default)',
+    )
+    parser.add_argument(
+        '-n',
+        '--noise',
+        type=float,
+        default=None,
+        help='Standard deviation of the normally distributed noise '
+        'added to the trace (0 by default)',
+    )
+    parser.add_argument(
+        '--low',
+        type=float,
+        default=12,
+        help='Binary logarithm of a number of traces below the threshold (12 by default)',
+    )
+    parser.add_argument(
+        '--high',
+        type=float,
+        default=24,
+        help='Binary logarithm of a number of traces above the threshold (24 by default)',
+    )
+    parser.add_argument(
+        '--resolution',
+        type=float,
+        default=0.125,
+        help='Width of the final interval of binary logarithms (0.125 by default)',
+    )
+    parser.add_argument(
+        '-e',
+        '--experiment-count',
+        type=int,
+        default=200,
+        help='Maximum number of experiments per probe (200 by default)',
+    )
+    parser.add_argument(
+        '--batch-size',
+        type=int,
+        default=10,
+        help='Number of experiments between the checks of the confidence interval '
+        '(10 by default)',
+    )
+    parser.add_argument(
+        '--target',
+        type=float,
+        default=50,
+        help='Value of M1 in percents whose crossing is searched for (50 by default)',
+    )
+    parser.add_argument(
+        '--confidence',
+        type=float,
+        default=0.95,
+        help='Confidence level of the intervals (0.95 by default)',
+    )
+    parser.add_argument(
+        '-r',
+        '--random-seed',
+        type=int,
+        default=0,
+        help='Random seed of the first experiment of every probe (0 by default)',
+    )
+    parser.add_argument(
+        '-j',
+        '--jobs',
+        type=int,
+        default=1,
+        help='Number of worker processes performing the experiments (1 by default)',
+    )
+    parser.add_argument(
+        '-c',
+        '--chunk-size',
+        type=int,
+        default=None,
+        help='Number of traces processed at a time by the attack (by default, all traces at once)',
+    )
+    args = parser.parse_args()
+    return (
+        Sha256 if args.bit_count == 32 else Sha512,
+        args.noise,
+        args.low,
+        args.high,
+        args.resolution,
+        args.experiment_count,
+        args.batch_size,
+        args.target,
+        args.confidence,
+        args.random_seed,
+        args.jobs,
+        args.chunk_size,
+    )
+
+
+if __name__ == '__main__':
+    (
+        sha2,
+        noise,
+        low,
+        high,
+        resolution,
+        experiment_count,
+        batch_size,
+        target,
+        confidence,
+        seed,
+        jobs,
+        chunk_size,
+    ) = parse()
+    # Suppress expected overflows in addition and subtraction
+    warnings.filterwarnings('ignore', category=RuntimeWarning)
+    threshold, below, total_count = find_threshold(
+        sha2,
+        noise,
+        low,
+        high,
+        resolution,
+        experiment_count,
+        seed,
+        target,
+        lambda trace_count, above, m1, interval, count: print(
+            '{:9d} traces: {:6.2f}% [{:6.2f}%, {:6.2f}%] in {:4d} experiments - {}'.format(
+                trace_count, m1, *interval, count, 'above' if above else 'below'
+            ),
+            flush=True,
+        ),
+        batch_size=batch_size,
+        confidence=confidence,
+        jobs=jobs,
+        chunk_size=chunk_size,
+    )
+    if threshold is None:
+        print(
+            'M1 does not exceed {:g}% at any probed number of traces, the threshold is above '
+            'them - try a greater "--high" ({} experiments performed)'.format(target, total_count)
+        )
+    elif not below:
+        print(
+            'M1 exceeds {:g}% at every probed number of traces, the threshold is at most {} '
+            'traces - try a smaller "--low" ({} experiments performed)'.format(
+                target, threshold, total_count
+            )
+        )
+    else:
+        print(
+            'M1 exceeds {:g}% at about {} traces ({} experiments performed)'.format(
+                target, threshold, total_count
+            )
+        )
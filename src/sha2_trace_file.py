@@ -0,0 +1,129 @@
+# Copyright © 2022-present FortifyIQ, Inc. All rights reserved. 
+#
+# This program, sha2-attack, is free software: you can redistribute it and/or modify
+# it under the terms and conditions of FortifyIQ’s free use license (”License”)
+# which is located at
+# https://raw.githubusercontent.com/fortify-iq/sha2-attack/master/LICENSE.
+# This license governs use of the accompanying software. If you use the
+# software, you accept this license. If you do not accept the license, do not
+# use the software.
+#
+# The License permits non-commercial use, but does not permit commercial use or
+# resale. This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY OR RIGHT TO ECONOMIC DAMAGES; without even the implied
+# warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+#
+# If you have any questions regarding the software of the license, please
+# contact kreimer@fortifyiq.com
+
+import contextlib
+import copy
+import json
+
+import numpy as np
+
+from sha2 import Sha256, Sha512
+from sha2_trace_set import as_trace_set, TraceSet
+
+# A trace set file consists of a header, which is a single line of JSON padded
+# with spaces to a multiple of ALIGNMENT bytes, followed by the known inputs
+# (N x 2 words) and then by the traces (N x 2 samples), both in C order.
+FORMAT = 'sha2-traces'
+VERSION = 1
+ALIGNMENT = 64
+
+
+def write_trace_file(path, sha, data, traces, iv=None, **parameters):
+    """Write a trace set to a file.
+
+    data and traces are either arrays, or a TraceSet and None (e.g., a
+    TraceStream, which is written chunk by chunk). iv is the secret initial
+    state, if known. The parameters (e.g., the seed and the noise that the
+    traces were generated with) are stored in the header as they are.
+    """
+
+    trace_set = as_trace_set(data, traces)
+    first_data, first_traces = next(trace_set.chunks())
+    trace_count = len(trace_set)
+    data_size = trace_count * 2 * first_data.dtype.itemsize
+    traces_size = trace_count * 2 * first_traces.dtype.itemsize
+    header = {
+        'format': FORMAT,
+        'version': VERSION,
+        'bit_count': sha.bit_count,
+        'trace_count': trace_count,
+        'data_dtype': first_data.dtype.str,
+        'traces_dtype': first_traces.dtype.str,
+        'iv': None if iv is None else [int(word) for word in iv],
+        'parameters': parameters,
+    }
+    line = json.dumps(header).encode()
+    header_size = (len(line) // ALIGNMENT + 1) * ALIGNMENT
+    with open(path, 'wb') as file:
+        file.write(line.ljust(header_size - 1) + b'\n')
+        file.truncate(header_size + data_size + traces_size)
+    file_data = np.memmap(path, first_data.dtype, 'r+', header_size, (trace_count, 2))
+    file_traces = np.memmap(
+        path, first_traces.dtype, 'r+', header_size + data_size, (trace_count, 2)
+    )
+    start = 0
+    for data, traces in trace_set.chunks():
+        file_data[start:start + len(data)] = data
+        file_traces[start:start + len(data)] = traces
+        start += len(data)
+    file_data.flush()
+    file_traces.flush()
+
+
+class TraceFile(TraceSet):
+    """Trace set stored in a file, memory-mapped for reading.
+
+    The known inputs and the traces are not read into memory, and the head of
+    the trace set is a view of the same mapping. Pickling a TraceFile (e.g.,
+    to pass it to a worker process) passes only the path, and the worker maps
+    the same file. The sha, the secret initial state (if known) and the
+    parameters of the trace set are in self.sha, self.iv, self.parameters.
+    """
+
+    def __init__(self, path, chunk_size=None, length=None):
+        self.path = path
+        with open(path, 'rb') as file:
+            line = file.readline()
+        header = json.loads(line)
+        if header.get('format') != FORMAT or header.get('version') != VERSION:
+            raise ValueError('{} is not a trace set file'.format(path))
+        self.sha = {32: Sha256, 64: Sha512}[header['bit_count']]
+        self.iv = None if header['iv'] is None else [self.sha.dtype(word) for word in header['iv']]
+        self.parameters = header['parameters']
+        trace_count = header['trace_count']
+        data_dtype = np.dtype(header['data_dtype'])
+        data = np.memmap(path, data_dtype, 'r', len(line), (trace_count, 2))
+        traces = np.memmap(
+            path,
+            header['traces_dtype'],
+            'r',
+            len(line) + trace_count * 2 * data_dtype.itemsize,
+            (trace_count, 2),
+        )
+        if length is not None:
+            data, traces = data[:length], traces[:length]
+        super().__init__(data, traces, chunk_size)
+
+    def head(self, count):
+        head = copy.copy(self)
+        head.data, head.traces = self.data[:count], self.traces[:count]
+        return head
+
+    def __reduce__(self):
+        return TraceFile, (self.path, self.chunk_size, len(self))
+
+    @contextlib.contextmanager
+    def shared(self):
+        # Worker processes map the file themselves
+        yield self
+
+
+def read_trace_file(path, chunk_size=None):
+    """Open a trace set file written by write_trace_file as a TraceFile, to
+    be processed in chunks of chunk_size traces"""
+    return TraceFile(path, chunk_size)
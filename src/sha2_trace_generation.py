@@ -1,4 +1,4 @@
-# Copyright © 2022-present FortifyIQ, Inc. All rights reserved. 
+# Copyright © 2022-present FortifyIQ, Inc. All rights reserved. 
 #
 # This program, sha2-attack, is free software: you can redistribute it and/or modify
 # it under the terms and conditions of FortifyIQ’s free use license (”License”)
@@ -16,35 +16,215 @@
 # If you have any questions regarding the software of the license, please
 # contact kreimer@fortifyiq.com
 
+import contextlib
+
 import numpy as np
 
+from sha2_threads import BLOCK_SIZE, map_blocks
+from sha2_trace_set import TraceSet
 
-def generate_traces(sha, trace_count, seed, noise):
-    state = np.random.RandomState(seed)
-    iv = list(state.randint(1 << sha.bit_count, size=8, dtype=sha.dtype))
-    data = state.randint(1 << sha.bit_count, size=(trace_count, 2), dtype=sha.dtype)
+# The number of blocks compressed at a time by compute_round_traces
+ROUND_CHUNK_SIZE = 1 << 15
+
+
+def initial_deltas(sha, iv):
+    """DeltaA_0, DeltaE_0 for the initial state iv"""
 
     temp1_0 = iv[7] + sha.s1(iv[4]) + sha.ch(iv[4], iv[5], iv[6]) + sha.round_const[0]
     temp2_0 = sha.s0(iv[0]) + sha.maj(iv[0], iv[1], iv[2])
-    delta_a = temp1_0 + temp2_0
-    delta_e = iv[3] + temp1_0
+    return temp1_0 + temp2_0, iv[3] + temp1_0
+
+
+def compute_traces(sha, iv, data):
+    """Noiseless traces of the first two rounds for the inputs data, as the
+    smallest unsigned integer type that holds them (uint8 or uint16).
+
+    data may also be a stack of the inputs of several experiments (E x N x 2),
+    in which case the words of iv are (E x 1) arrays.
+    """
+
+    delta_a, delta_e = initial_deltas(sha, iv)
     hd1c = (
         sha.hd(iv[0], iv[1]) + sha.hd(iv[1], iv[2]) + sha.hd(iv[4], iv[5]) + sha.hd(iv[5], iv[6])
     )
     hd0c = hd1c + sha.hd(iv[2], iv[3]) + sha.hd(iv[6], iv[7])
-    a1 = data[:, 0] + delta_a
-    e1 = data[:, 0] + delta_e
+    # The variable parts of the traces are at most 2 and 4 words
+    bound = np.max(np.maximum(hd0c + 2 * sha.bit_count, hd1c + 4 * sha.bit_count))
+    traces = np.empty(data.shape, dtype=np.uint8 if bound <= 0xff else np.uint16)
+    if data.ndim == 2 and len(data) > BLOCK_SIZE:
+        # Blocks of traces on the threads of sha2_threads
+
+        def compute_block(block):
+            traces[block] = compute_traces(sha, iv, data[block])
+
+        map_blocks(compute_block, len(data))
+        return traces
+    a1 = data[..., 0] + delta_a
+    e1 = data[..., 0] + delta_e
     hd0v = sha.hd(a1, iv[0]) + sha.hd(e1, iv[4])
+    traces[..., 0] = hd0c + hd0v
 
     temp1_1 = iv[6] + sha.s1(e1) + sha.ch(e1, iv[4], iv[5]) + sha.round_const[1]
     temp2_1 = sha.s0(a1) + sha.maj(a1, iv[0], iv[1])
-    a2 = data[:, 1] + temp1_1 + temp2_1
-    e2 = data[:, 1] + iv[2] + temp1_1
-    hd1v = hd0v + sha.hd(a2, a1) + sha.hd(e2, e1)
+    a2 = data[..., 1] + temp1_1 + temp2_1
+    e2 = data[..., 1] + iv[2] + temp1_1
+    traces[..., 1] = hd1c + hd0v + sha.hd(a2, a1) + sha.hd(e2, e1)
+
+    return traces
+
+
+def compute_round_traces(sha, iv, blocks, round_count, chunk_size=None):
+    """Noiseless traces of the first round_count rounds (N x round_count,
+    uint16) for the known blocks (N x 16).
+
+    Only the first round_count rounds are computed, so the cost is linear in
+    round_count. The blocks are compressed as batches of chunk_size blocks
+    (ROUND_CHUNK_SIZE by default), which bounds the memory used by the
+    message schedule and the registers, and the batches are spread across
+    the threads of sha2_threads.
+    """
+    compress = sha()
+    traces = np.empty((len(blocks), round_count), dtype=np.uint16)
+
+    def compute_chunk(chunk):
+        _, chunk_traces = compress.run_rounds(
+            blocks[chunk].T.copy(), iv[:8], round_count, round_count
+        )
+        traces[chunk] = chunk_traces.T
+
+    # The chunks are spread across the threads of sha2_threads
+    map_blocks(compute_chunk, len(blocks), chunk_size or ROUND_CHUNK_SIZE)
+    return traces
+
+
+def generate_traces(sha, trace_count, seed, noise, single=False, round_count=2, chunk_size=None):
+    """Known inputs, traces and the secret initial state (followed by
+    DeltaA_0, DeltaE_0) for the given seed.
+
+    The traces are the samples of the first round_count rounds. With two
+    rounds (the default), the known inputs are the first two words of the
+    blocks (N x 2), and noiseless traces are integers (see compute_traces).
+    With more rounds, the known inputs are whole blocks (N x 16), and
+    noiseless traces are uint16 (see compute_round_traces, to which
+    chunk_size is passed). Noisy traces are float64, or float32 if single.
+    """
+    state = np.random.RandomState(seed)
+    iv = list(state.randint(1 << sha.bit_count, size=8, dtype=sha.dtype))
+    if round_count == 2:
+        data = state.randint(1 << sha.bit_count, size=(trace_count, 2), dtype=sha.dtype)
+        traces = compute_traces(sha, iv, data)
+    else:
+        data = state.randint(1 << sha.bit_count, size=(trace_count, 16), dtype=sha.dtype)
+        traces = compute_round_traces(sha, iv, data, round_count, chunk_size)
+    if noise:
+        traces = traces.astype(np.float32 if single else float)
+        traces += state.normal(scale=noise, size=(trace_count, round_count))
+
+    return data, traces, iv + list(initial_deltas(sha, iv))
+
+
+def generate_round_traces(sha, iv, trace_count, seed, noise, round_count, single=False):
+    """Random known blocks (N x 16) for the given seed and their traces of the
+    first round_count rounds (N x round_count) for the secret initial state
+    iv (see compute_round_traces).
+
+    Noiseless traces are uint16. Noisy traces are float64, or float32 if
+    single.
+    """
+    state = np.random.RandomState(seed)
+    blocks = state.randint(1 << sha.bit_count, size=(trace_count, 16), dtype=sha.dtype)
+    traces = compute_round_traces(sha, iv, blocks, round_count)
+    if noise:
+        traces = traces.astype(np.float32 if single else float)
+        traces += state.normal(scale=noise, size=traces.shape)
+    return blocks, traces
+
 
-    traces = np.array([hd0c + hd0v, hd1c + hd1v]).transpose()
+def generate_trace_batch(sha, trace_count, seeds, noise, single=False):
+    """generate_traces for every one of seeds at once, as stacks of the inputs
+    and traces of all the experiments (E x N x 2) and the list of their
+    initial states. The traces of all the experiments are computed in one
+    vectorized computation, and have the same values as those of
+    generate_traces (noiseless traces may be stored as a wider integer type)."""
+
+    states = [np.random.RandomState(seed) for seed in seeds]
+    ivs = np.array(
+        [state.randint(1 << sha.bit_count, size=8, dtype=sha.dtype) for state in states]
+    ).reshape(len(states), 8)
+    data = np.array(
+        [
+            state.randint(1 << sha.bit_count, size=(trace_count, 2), dtype=sha.dtype)
+            for state in states
+        ]
+    ).reshape(len(states), trace_count, 2)
+
+    traces = compute_traces(sha, list(ivs.T[:, :, None]), data)
     if noise:
-        traces = traces.astype(float)
-        traces += state.normal(scale=noise, size=(trace_count, 2))
+        traces = traces.astype(np.float32 if single else float)
+        for state, experiment_traces in zip(states, traces):
+            experiment_traces += state.normal(scale=noise, size=(trace_count, 2))
+
+    deltas = np.array(initial_deltas(sha, list(ivs.T)), dtype=sha.dtype).T.reshape(-1, 2)
+    return data, traces, [list(iv) + list(delta) for iv, delta in zip(ivs, deltas)]
+
+
+class TraceStream(TraceSet):
+    """The trace set of generate_traces(sha, trace_count, seed, noise, single),
+    generated chunk by chunk of chunk_size traces.
+
+    The concatenation of the chunks is the same as the output of
+    generate_traces regardless of the chunk size, but the full trace set is
+    never held in memory. The chunks are generated anew on every pass over the
+    trace set. The secret initial state is in self.iv.
+    """
+
+    def __init__(self, sha, trace_count, seed, noise, chunk_size, single=False, length=None):
+        self.sha = sha
+        self.trace_count = trace_count
+        self.seed = seed
+        self.noise = noise
+        self.single = single
+        self.chunk_size = chunk_size
+        # A head of the stream has the same secret and noise, but fewer traces
+        self.length = trace_count if length is None else min(length, trace_count)
+        iv = list(
+            np.random.RandomState(seed).randint(1 << sha.bit_count, size=8, dtype=sha.dtype)
+        )
+        self.iv = iv + list(initial_deltas(sha, iv))
+
+    def __len__(self):
+        return self.length
+
+    def head(self, count):
+        return TraceStream(
+            self.sha, self.trace_count, self.seed, self.noise, self.chunk_size, self.single, count
+        )
+
+    def chunks(self):
+        data_state = np.random.RandomState(self.seed)
+        data_state.randint(1 << self.sha.bit_count, size=8, dtype=self.sha.dtype)
+        if self.noise:
+            # The noise follows all the inputs in the random sequence
+            noise_state = np.random.RandomState(self.seed)
+            noise_state.randint(1 << self.sha.bit_count, size=8, dtype=self.sha.dtype)
+            for start in range(0, self.trace_count, self.chunk_size):
+                noise_state.randint(
+                    1 << self.sha.bit_count,
+                    size=(min(self.chunk_size, self.trace_count - start), 2),
+                    dtype=self.sha.dtype,
+                )
+        for start in range(0, self.length, self.chunk_size):
+            count = min(self.chunk_size, self.length - start)
+            data = data_state.randint(
+                1 << self.sha.bit_count, size=(count, 2), dtype=self.sha.dtype
+            )
+            traces = compute_traces(self.sha, self.iv, data)
+            if self.noise:
+                traces = traces.astype(np.float32 if self.single else float)
+                traces += noise_state.normal(scale=self.noise, size=(count, 2))
+            yield data, traces
 
-    return data, traces, iv + [delta_a, delta_e]
+    @contextlib.contextmanager
+    def shared(self):
+        # Worker processes generate the stream themselves
+        yield self
@@ -0,0 +1,241 @@
+# Copyright © 2022-present FortifyIQ, Inc. All rights reserved. 
+#
+# This program, sha2-attack, is free software: you can redistribute it and/or modify
+# it under the terms and conditions of FortifyIQ’s free use license (”License”)
+# which is located at
+# https://raw.githubusercontent.com/fortify-iq/sha2-attack/master/LICENSE.
+# This license governs use of the accompanying software. If you use the
+# software, you accept this license. If you do not accept the license, do not
+# use the software.
+#
+# The License permits non-commercial use, but does not permit commercial use or
+# resale. This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY OR RIGHT TO ECONOMIC DAMAGES; without even the implied
+# warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+#
+# If you have any questions regarding the software of the license, please
+# contact kreimer@fortifyiq.com
+
+import contextlib
+from multiprocessing.shared_memory import SharedMemory
+
+import numpy as np
+
+from sha2_bit_planes import BitPlaneIndex
+from sha2_threads import map_blocks
+
+
+class TraceSet:
+    """Known inputs and the corresponding traces, processed chunk by chunk.
+
+    data (N x 2 words) and traces (N x 2 samples) may be in-memory arrays or
+    memory-mapped files. Every decision of the attack reads the trace set in
+    chunks of at most chunk_size traces and keeps only the per-class sums and
+    counts, so that the memory used by the attack is bounded by the chunk size
+    and not by the number of traces. By default, the whole trace set is one
+    chunk.
+    """
+
+    def __init__(self, data, traces, chunk_size=None):
+        self.data = data
+        self.traces = traces
+        self.chunk_size = chunk_size or max(len(data), 1)
+
+    def __len__(self):
+        return len(self.data)
+
+    def head(self, count):
+        """The trace set of the first count traces"""
+        return TraceSet(self.data[:count], self.traces[:count], self.chunk_size)
+
+    def chunks(self):
+        """Iterate over (data, traces) chunks in order"""
+        for start in range(0, len(self), self.chunk_size):
+            yield (
+                self.data[start:start + self.chunk_size],
+                self.traces[start:start + self.chunk_size],
+            )
+
+    def partition_sums(self, classify, class_count, column):
+        """Sum of the traces and number of traces in every class of a
+        partition, computed in a single pass over the trace set.
+
+        classify maps a chunk of data to the class index of every trace in it
+        (or to an array of class indices for every trace, e.g., one row per
+        hypothesis). Traces whose class index is class_count or greater are
+        ignored.
+
+        The classes of every chunk are counted and summed by blocks of traces
+        on the threads of sha2_threads, with the same result for any number
+        of threads.
+        """
+        sums = np.zeros(class_count)
+        counts = np.zeros(class_count, dtype=np.int64)
+        for data, traces in self.chunks():
+            classes = classify(data).astype(np.intp)
+            weights = traces[:, column]
+
+            def sum_block(block):
+                block_classes = classes[..., block]
+                block_weights = weights[block]
+                if block_classes.ndim > 1:
+                    block_weights = np.broadcast_to(
+                        block_weights.astype(float), block_classes.shape
+                    )
+                block_classes, block_weights = block_classes.ravel(), block_weights.ravel()
+                return (
+                    np.bincount(block_classes, weights=block_weights, minlength=class_count)[
+                        :class_count
+                    ],
+                    np.bincount(block_classes, minlength=class_count)[:class_count],
+                )
+
+            for block_sums, block_counts in map_blocks(sum_block, len(data)):
+                sums += block_sums
+                counts += block_counts
+        return sums, counts
+
+    def partition_averages(self, classify, class_count, column, key=None):
+        """Average trace in every class of a partition (see partition_sums).
+
+        key identifies the partition among all the partitions of the trace
+        set. It is used only by trace sets that cache the statistics (see
+        PrefixStatistics).
+        """
+        sums, counts = self.partition_sums(classify, class_count, column)
+        return sums / counts
+
+    def bit_planes(self, sha2):
+        """BitPlaneIndex of the trace set for stage 1, or None if the trace set
+        is processed in several chunks or the traces are not integers"""
+
+        if len(self) == 0 or self.chunk_size < len(self):
+            return None
+        data, traces = next(self.chunks())
+        if traces.dtype.kind not in 'ui':
+            return None
+        return BitPlaneIndex.build(sha2, data, traces)
+
+    @contextlib.contextmanager
+    def shared(self):
+        """Copy the trace set into shared memory once, and yield it as a
+        SharedTraceSet that can be passed to worker processes"""
+
+        memory = SharedMemory(create=True, size=max(self.data.nbytes + self.traces.nbytes, 1))
+        try:
+            shared = SharedTraceSet(
+                memory,
+                (self.data.shape, self.data.dtype),
+                (self.traces.shape, self.traces.dtype),
+                self.chunk_size,
+            )
+            shared.data[:] = self.data
+            shared.traces[:] = self.traces
+            yield shared
+        finally:
+            # The memory is released when the last array using it is deleted
+            memory.unlink()
+
+
+class SharedTraceSet(TraceSet):
+    """TraceSet in shared memory. Pickling it (e.g., to pass it to a worker
+    process) passes only the name of the shared memory block, and unpickling
+    attaches to the same block without copying the traces."""
+
+    def __init__(self, memory, data_layout, traces_layout, chunk_size):
+        self.memory = memory
+        data = np.ndarray(*data_layout, buffer=memory.buf)
+        traces = np.ndarray(*traces_layout, buffer=memory.buf, offset=data.nbytes)
+        super().__init__(data, traces, chunk_size)
+
+    def __reduce__(self):
+        return (
+            attach_shared_trace_set,
+            (
+                self.memory.name,
+                (self.data.shape, self.data.dtype),
+                (self.traces.shape, self.traces.dtype),
+                self.chunk_size,
+            ),
+        )
+
+
+def attach_shared_trace_set(name, data_layout, traces_layout, chunk_size):
+    return SharedTraceSet(SharedMemory(name), data_layout, traces_layout, chunk_size)
+
+
+def as_trace_set(data, traces, chunk_size=None):
+    """data and traces as a TraceSet. data may already be a TraceSet, in which
+    case traces is None and chunk_size is ignored"""
+    return data if isinstance(data, TraceSet) else TraceSet(data, traces, chunk_size)
+
+
+class PrefixStatistics:
+    """Partition statistics of the prefixes of a trace set, extended
+    incrementally from a shorter prefix to a longer one.
+
+    The statistics of a partition are cached under its key. When a longer
+    prefix is attacked, a partition that was already used on a shorter
+    prefix is extended by the traces that follow that prefix only, so that
+    attacking a sequence of nested prefixes in ascending order costs about as
+    much as attacking the longest one. trace_set must be array-based (e.g., a
+    TraceSet or a TraceFile).
+    """
+
+    def __init__(self, trace_set):
+        self.trace_set = trace_set
+        # {(key, column): (prefix length, sums, counts)}
+        self.cache = {}
+        # The partitions used since the last call to discard_unused
+        self.used = set()
+
+    def prefix(self, count):
+        """The trace set of the first count traces"""
+        return PrefixTraceSet(self, min(count, len(self.trace_set)))
+
+    def discard_unused(self):
+        """Drop the statistics of the partitions that were not used since the
+        last call, e.g., those of the rejected hypotheses"""
+        self.cache = {name: value for name, value in self.cache.items() if name in self.used}
+        self.used = set()
+
+    def slice(self, start, end):
+        return TraceSet(
+            self.trace_set.data[start:end],
+            self.trace_set.traces[start:end],
+            self.trace_set.chunk_size,
+        )
+
+
+class PrefixTraceSet(TraceSet):
+    """Prefix of a trace set whose partition statistics are shared through a
+    PrefixStatistics"""
+
+    def __init__(self, statistics, count):
+        self.statistics = statistics
+        full = statistics.trace_set
+        super().__init__(full.data[:count], full.traces[:count], full.chunk_size)
+
+    def head(self, count):
+        # As with slicing, a count of None stands for all the traces
+        return self.statistics.prefix(len(self) if count is None else min(count, len(self)))
+
+    def bit_planes(self, sha2):
+        # The statistics are extended incrementally instead
+        return None
+
+    def partition_averages(self, classify, class_count, column, key=None):
+        if key is None:
+            return super().partition_averages(classify, class_count, column)
+        cache = self.statistics.cache
+        self.statistics.used.add((key, column))
+        length, sums, counts = cache.get((key, column), (0, 0, 0))
+        if length > len(self):
+            length, sums, counts = 0, 0, 0
+        if length < len(self):
+            new_sums, new_counts = self.statistics.slice(length, len(self)).partition_sums(
+                classify, class_count, column
+            )
+            sums, counts = sums + new_sums, counts + new_counts
+            cache[key, column] = len(self), sums, counts
+        return sums / counts
@@ -0,0 +1,98 @@
+# Copyright © 2022-present FortifyIQ, Inc. All rights reserved. 
+#
+# This program, sha2-attack, is free software: you can redistribute it and/or modify
+# it under the terms and conditions of FortifyIQ’s free use license (”License”)
+# which is located at
+# https://raw.githubusercontent.com/fortify-iq/sha2-attack/master/LICENSE.
+# This license governs use of the accompanying software. If you use the
+# software, you accept this license. If you do not accept the license, do not
+# use the software.
+#
+# The License permits non-commercial use, but does not permit commercial use or
+# resale. This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY OR RIGHT TO ECONOMIC DAMAGES; without even the implied
+# warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+#
+# If you have any questions regarding the software of the license, please
+# contact kreimer@fortifyiq.com
+
+import numpy as np
+
+
+def round_predictions(sha2, candidates, blocks, first_round, round_count):
+    """Hamming distances of rounds first_round, ..., round_count - 1 predicted
+    by every one of candidates for the known blocks (N x 16), as a
+    (candidates x N x rounds) array.
+
+    The blocks of all the candidates are processed as a single batch, with
+    one column per candidate and block, and only the first round_count rounds
+    are computed (see Sha2.run_rounds).
+    """
+    count = len(blocks)
+    ivs = np.repeat(np.array(candidates, dtype=sha2.dtype)[:, :8], count, axis=0)
+    _, traces = sha2().run_rounds(
+        np.tile(blocks.T, len(candidates)), ivs, round_count, round_count
+    )
+    return traces[first_round:].reshape(-1, len(candidates), count).transpose(1, 2, 0)
+
+
+def verify_candidates(
+    sha2,
+    blocks,
+    traces,
+    candidates,
+    first_round=2,
+    start_count=64,
+    reject_z=5.0,
+):
+    """Rank the candidates for the secret initial state by the correlation
+    between the Hamming distances they predict for the later rounds and the
+    traces.
+
+    blocks are known blocks (N x 16), and traces their traces of the first k
+    rounds (N x k). Only the rounds from first_round on are compared, since
+    all the candidates agree on the first two rounds. The traces are used in
+    prefixes of start_count, 2 * start_count, ... traces, and only the new
+    traces of every prefix are predicted. After every prefix, the candidates
+    whose Fisher-transformed correlation is below that of the best candidate
+    by more than reject_z standard errors are rejected, so that clearly wrong
+    candidates are rejected after a few traces. The verification stops when a
+    single candidate remains or all the traces are used.
+
+    Returns the remaining candidates and their correlations, best first.
+    """
+    alive = list(range(len(candidates)))
+    measured = traces[:, first_round:].astype(float)
+    round_count = traces.shape[1]
+    # The sums of the correlation for every candidate
+    sum_x, sum_xx, sum_xy = np.zeros((3, len(candidates)))
+    sum_y, sum_yy, sample_count = 0.0, 0.0, 0
+    correlations = np.zeros(len(candidates))
+    start, end = 0, min(start_count, len(blocks))
+    # The first prefix is used even for a single candidate, for its correlation
+    while start < end and (len(alive) > 1 or sample_count == 0):
+        predictions = round_predictions(
+            sha2,
+            [candidates[index] for index in alive],
+            blocks[start:end],
+            first_round,
+            round_count,
+        ).reshape(len(alive), -1)
+        y = measured[start:end].ravel()
+        sum_x[alive] += predictions.sum(axis=1)
+        sum_xx[alive] += np.einsum('ij,ij->i', predictions, predictions, dtype=float)
+        sum_xy[alive] += predictions @ y
+        sum_y += y.sum()
+        sum_yy += y @ y
+        sample_count += len(y)
+        covariance = sample_count * sum_xy[alive] - sum_x[alive] * sum_y
+        variances = (sample_count * sum_xx[alive] - sum_x[alive] ** 2) * (
+            sample_count * sum_yy - sum_y ** 2
+        )
+        correlations[alive] = covariance / np.sqrt(np.maximum(variances, 1e-300))
+        scores = np.arctanh(np.clip(correlations[alive], -1 + 1e-12, 1 - 1e-12))
+        margin = reject_z * np.sqrt(2 / max(sample_count - 3, 1))
+        alive = [index for index, score in zip(alive, scores) if score >= scores.max() - margin]
+        start, end = end, min(2 * end, len(blocks))
+    alive.sort(key=lambda index: -correlations[index])
+    return [candidates[index] for index in alive], [correlations[index] for index in alive]
@@ -16,11 +16,16 @@
 # If you have any questions regarding the software of the license, please
 # contact kreimer@fortifyiq.com
 
+import json
+import tracemalloc
 import warnings
 import argparse
 
 from sha2 import Sha256, Sha512
 from sha2_end_to_end import end_to_end_attack
+from sha2_profile import Profiler
+from sha2_threads import set_threads
+from sha2_trace_file import read_trace_file
 
 
 def parse():
@@ -75,6 +80,125 @@ def parse():
         action='store_true',
         help='Perform the second stage only on the correct hypothesis',
     )
+    parser.add_argument(
+        '-c',
+        '--chunk-size',
+        type=int,
+        default=None,
+        help='Number of traces processed at a time by the attack (by default, all traces at once)',
+    )
+    parser.add_argument(
+        '-j',
+        '--jobs',
+        type=int,
+        default=1,
+        help='Number of worker processes performing the experiments (1 by default)',
+    )
+    parser.add_argument(
+        '--threads',
+        type=int,
+        default=1,
+        help='Number of threads computing the partition statistics and the traces in every '
+        'process, with the same results for any number of threads (1 by default)',
+    )
+    parser.add_argument(
+        '--stage2-jobs',
+        type=int,
+        default=1,
+        help='Number of worker processes performing stage 2 of every experiment (1 by default)',
+    )
+    parser.add_argument(
+        '-m',
+        '--memory-limit',
+        type=int,
+        default=None,
+        help='Memory in MB used for a batch of hypotheses at stage 2 (256 MB by default)',
+    )
+    parser.add_argument(
+        '--screen-bits',
+        type=int,
+        default=None,
+        help='Number of bits of stage 2 on which the hypotheses are pre-screened, 0 - no '
+        'pre-screening (by default, 11 for SHA256 and 26 for SHA512 if the hypotheses do not '
+        'fit in a single batch of stage 2)',
+    )
+    parser.add_argument(
+        '--screen-count',
+        type=int,
+        default=16384,
+        help='Number of traces used for the pre-screening (16K by default)',
+    )
+    parser.add_argument(
+        '--stream',
+        action='store_true',
+        help='Generate the traces in chunks of CHUNK_SIZE on every pass of the attack '
+        'instead of holding them in memory (requires "-c")',
+    )
+    parser.add_argument(
+        '--float32',
+        action='store_true',
+        help='Generate noisy traces as 32-bit rather than 64-bit floating point numbers',
+    )
+    parser.add_argument(
+        '--save-traces',
+        default=None,
+        metavar='FILE',
+        help='Write the generated traces to a trace set file (requires "-e 1")',
+    )
+    parser.add_argument(
+        '--load-traces',
+        default=None,
+        metavar='FILE',
+        help='Attack the traces in a trace set file instead of generating them, '
+        'with the bit size, trace count, noise and seed of the file (requires "-e 1")',
+    )
+    parser.add_argument(
+        '--ci-width',
+        type=float,
+        default=None,
+        help='Stop the experiments as soon as the confidence interval of M1 is at most this '
+        'many percents wide, performing at most EXPERIMENT_COUNT experiments (None by default)',
+    )
+    parser.add_argument(
+        '--confidence',
+        type=float,
+        default=0.95,
+        help='Confidence level of the confidence intervals (0.95 by default)',
+    )
+    parser.add_argument(
+        '--ci-lsb',
+        action='store_true',
+        help='Stop the experiments only when the confidence interval of M2 is also narrow enough',
+    )
+    parser.add_argument(
+        '--batch-size',
+        type=int,
+        default=None,
+        help='Attack the traces of this many experiments at once, amortizing the overhead of '
+        'small trace sets (None by default)',
+    )
+    parser.add_argument(
+        '--verify-count',
+        type=int,
+        default=0,
+        help='Rank the candidates on this many further traces of the later rounds, and keep only '
+        'the best one (0 by default - no verification)',
+    )
+    parser.add_argument(
+        '--verify-rounds',
+        type=int,
+        default=8,
+        help='Number of rounds of the verification traces (8 by default)',
+    )
+    parser.add_argument(
+        '--profile',
+        nargs='?',
+        const='-',
+        default=None,
+        metavar='FILE',
+        help='Profile the stages and the bits of the attack, and print the profile '
+        '(or write it as JSON to FILE)',
+    )
     parser.add_argument(
         '-v',
         '--verbose',
@@ -85,17 +209,64 @@ def parse():
     args = parser.parse_args()
     assert not args.verbose or args.experiment_count == 1, \
         '"-v" is permitted only if the experiment count is 1 ("-e 1" or default)'
+    assert not args.stream or args.chunk_size, '"--stream" requires "-c"'
+    assert not (args.save_traces or args.load_traces) or args.experiment_count == 1, \
+        '"--save-traces" and "--load-traces" are permitted only if the experiment count is 1'
+    assert not (args.load_traces and args.stream), \
+        '"--load-traces" and "--stream" are mutually exclusive'
+    assert args.verify_rounds > 2, '"--verify-rounds" must be greater than 2'
+    assert not args.profile or args.jobs == 1, '"--profile" is permitted only if "-j 1" (default)'
+    assert not args.batch_size or not (
+        args.verbose
+        or args.chunk_size
+        or args.stage2_jobs > 1
+        or args.screen_bits
+        or args.stream
+        or args.save_traces
+        or args.load_traces
+        or args.profile
+        or args.verify_count
+    ), '"--batch-size" is permitted only with "-b", "-t", "-s", "-n", "-e", "-r", "-f", "-j", ' \
+        '"-m", "--float32" and the confidence interval options'
+
+    sha2 = Sha256 if args.bit_count == 32 else Sha512
+    trace_count, noise, seed = args.trace_count, args.noise, args.random_seed
+    if args.load_traces:
+        trace_file = read_trace_file(args.load_traces)
+        assert trace_file.iv is not None, \
+            'The secret initial state is not stored in {}'.format(args.load_traces)
+        sha2, trace_count = trace_file.sha, len(trace_file)
+        noise = trace_file.parameters.get('noise')
+        seed = trace_file.parameters.get('seed')
 
     return (
-        Sha256 if args.bit_count == 32 else Sha512,
-        args.trace_count,
-        min(args.trace_count, args.second_stage_count) \
-            if args.second_stage_count else args.trace_count,
-        args.noise,
+        sha2,
+        trace_count,
+        min(trace_count, args.second_stage_count) \
+            if args.second_stage_count else trace_count,
+        noise,
         args.experiment_count,
-        args.random_seed,
+        seed,
         args.filter_hypo,
         args.verbose,
+        args.chunk_size,
+        args.jobs,
+        args.stage2_jobs,
+        args.memory_limit << 20 if args.memory_limit else None,
+        args.screen_bits,
+        args.screen_count,
+        args.stream,
+        args.load_traces,
+        args.save_traces,
+        args.float32,
+        args.profile,
+        args.ci_width,
+        args.confidence,
+        args.ci_lsb,
+        args.batch_size,
+        args.verify_count,
+        args.verify_rounds,
+        args.threads,
     )
 
 
@@ -110,12 +281,73 @@ if __name__ == '__main__':
         seed,
         filter_hypo,
         verbose,
+        chunk_size,
+        jobs,
+        stage2_jobs,
+        memory_limit,
+        screen_bits,
+        screen_count,
+        stream,
+        load_traces,
+        save_traces,
+        single,
+        profile,
+        ci_width,
+        confidence,
+        lsb_ci,
+        batch_size,
+        verify_count,
+        verify_rounds,
+        threads,
     ) = parse()
     # Suppress expected overflows in addition and subtraction
     warnings.filterwarnings('ignore', category=RuntimeWarning)
+    set_threads(threads)
+    profiler, report = None, {}
+    if profile:
+        profiler = Profiler()
+        tracemalloc.start()
     result_ratio, lsb_success_ratio = end_to_end_attack(
-        sha2, trace_count, second_stage_count, noise, experiment_count, seed, filter_hypo, verbose
+        sha2,
+        trace_count,
+        second_stage_count,
+        noise,
+        experiment_count,
+        seed,
+        filter_hypo,
+        verbose,
+        chunk_size,
+        jobs,
+        stage2_jobs,
+        memory_limit,
+        screen_bits,
+        screen_count,
+        stream,
+        load_traces,
+        save_traces,
+        single,
+        profiler,
+        ci_width,
+        confidence,
+        lsb_ci,
+        report,
+        batch_size,
+        verify_count,
+        verify_rounds,
     )
     if not verbose:
         print('{:5.2f}% correct answers'.format(result_ratio))
         print('{:5.2f}% correct least significant bits'.format(lsb_success_ratio))
+    if ci_width is not None:
+        print('{} experiments performed'.format(report['experiment_count']))
+        print(
+            '{:.0%} confidence intervals: M1 [{:.2f}%, {:.2f}%], M2 [{:.2f}%, {:.2f}%]'.format(
+                confidence, *report['m1_interval'], *report['m2_interval']
+            )
+        )
+    if profile == '-':
+        print()
+        print('\n'.join(profiler.format_table()))
+    elif profile:
+        with open(profile, 'w') as file:
+            json.dump({'records': profiler.records, 'summary': profiler.summary()}, file, indent=1)